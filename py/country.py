@@ -1,4 +1,7 @@
 import collections
+
+import numpy
+
 from gputils import *
 
 
@@ -52,4 +55,76 @@ def read_countries(path_geonames=None, path_prior=None):
     for iso in iso_countries:
         iso_countries[iso].prior = (priors[iso] + k) / 1.01
 
-    return iso_countries.values()
\ No newline at end of file
+    return iso_countries.values()
+
+
+class CountryIndex:
+    """
+    A fixed ordering of countries shared by the features and inferrer.
+
+    Distributions over countries can be represented as dense float arrays
+    aligned with this ordering, or as sparse (index array, value array)
+    pairs. The whois and geoip "uk" code is mapped to "gb" here, once.
+    """
+    def __init__(self, countries=None):
+        if not countries: countries = read_countries()
+        self.countries = sorted(countries, key=lambda c: c.iso)
+        self.isos = [c.iso for c in self.countries]
+        self.iso_index = dict((iso, i) for (i, iso) in enumerate(self.isos))
+        if u'gb' in self.iso_index:
+            self.iso_index[u'uk'] = self.iso_index[u'gb']
+        self.points = {}
+
+    def __len__(self):
+        return len(self.isos)
+
+    def index(self, iso):
+        return self.iso_index[iso]
+
+    def point(self, iso):
+        """
+        Returns the sparse representation of all mass on a single country.
+        These are shared, so callers must not modify them.
+        """
+        if iso not in self.points:
+            self.points[iso] = (
+                numpy.array([self.iso_index[iso]], dtype=int),
+                numpy.ones(1)
+            )
+        return self.points[iso]
+
+    def sparse(self, dist):
+        merged = collections.defaultdict(float)
+        for (iso, p) in dist.items():
+            merged[self.iso_index[iso]] += p
+        indexes = sorted(merged)
+        return (
+            numpy.array(indexes, dtype=int),
+            numpy.array([merged[i] for i in indexes], dtype=float)
+        )
+
+    def dense(self, dist):
+        values = numpy.zeros(len(self.isos))
+        (indexes, probs) = self.sparse(dist)
+        values[indexes] = probs
+        return values
+
+    def to_dict(self, values):
+        return dict(zip(self.isos, values.tolist()))
+
+INDEX_INST = None
+
+def get_country_index():
+    global INDEX_INST
+    if not INDEX_INST: INDEX_INST = CountryIndex()
+    return INDEX_INST
+
+def test_country_index():
+    index = CountryIndex()
+    assert(len(index) == len(index.countries))
+    assert(index.index('uk') == index.index('gb'))
+    (indexes, probs) = index.sparse({'gb' : 0.25, 'uk' : 0.25, 'us' : 0.5})
+    assert(len(indexes) == 2)
+    assert(index.to_dict(index.dense({'uk' : 1.0}))['gb'] == 1.0)
+    (indexes, probs) = index.point('fr')
+    assert(index.isos[indexes[0]] == 'fr' and probs[0] == 1.0)
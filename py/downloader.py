@@ -1,12 +1,13 @@
 import chardet
 import codecs
-import os
 import re
-import shutil
-import tempfile
+import StringIO
 import urlparse
 import urllib2
 
+from HTMLParser import HTMLParser, HTMLParseError
+from xml.parsers import expat
+
 from bs4 import BeautifulSoup
 
 from gputils import *
@@ -14,50 +15,183 @@ from gputils import *
 
 BINARY_EXTS = set(['pdf', 'jpg', 'gif', 'xls', 'doc', 'png', 'zip', 'swf', 'tif', 'dot', 'jpeg', 'xlsx'])
 BLOCKSIZE = 1048576 # or some other, desired size in bytes
-ENCODING_DETECT_BYTES = 10*1024*1024   # 10 MBs
-
-
-def encoding_works(path, encoding):
-    f = None
+CHARSET_CHECK_BYTES = 64*1024   # prefix decoded to validate a candidate charset
+CHARDET_BYTES = 64*1024   # most bytes given to chardet
+MAX_DOWNLOAD_BYTES = 10*1024*1024   # longer bodies are truncated
+MAX_TEXT_CONTENT_LENGTH = 100*1024*1024   # larger text resources are not worth downloading
+
+# at most one page request per second to each host
+DOWNLOAD_LIMITER = RateLimiter(1.0)
+
+# How url_to_text extracts text: 'soup' parses pages with BeautifulSoup,
+# 'stream' uses the streaming extractors, which skip scripts and styles.
+TEXT_EXTRACTOR = 'soup'
+
+def set_text_extractor(name):
+    global TEXT_EXTRACTOR
+    if name not in ('soup', 'stream'):
+        raise GPException('unknown text extractor: %s' % name)
+    TEXT_EXTRACTOR = name
+
+
+def read_body(response, max_bytes=MAX_DOWNLOAD_BYTES):
+    """
+    Reads at most max_bytes of a response body into memory. Returns a list
+    of byte strings and whether the body was complete.
+    """
+    chunks = []
+    n = 0
+    while n < max_bytes:
+        block = response.read(min(BLOCKSIZE, max_bytes - n))
+        if not block:
+            return (chunks, True)
+        chunks.append(block)
+        n += len(block)
+    return (chunks, not response.read(1))
+
+
+def head(chunks, n):
+    """
+    Returns the first n bytes of a list of byte strings.
+    """
+    parts = []
+    for c in chunks:
+        if n <= 0:
+            break
+        parts.append(c[:n])
+        n -= len(c)
+    return ''.join(parts)
+
+
+def decode_chunks(chunks, encoding, complete=True, errors='strict'):
+    """
+    Generates the text of a list of byte strings, decoding incrementally.
+    If the bytes are incomplete, a character cut off at the end is dropped.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    for c in chunks:
+        yield decoder.decode(c)
+    if complete:
+        yield decoder.decode('', True)
+
+
+def encoding_works(prefix, encoding, complete=False):
+    """
+    Returns true if a prefix of the body decodes with an encoding. Unless
+    the prefix is the complete body, a character cut off at its end is fine.
+    """
     try:
-        f = codecs.open(path, encoding=encoding)
-        while f.read(BLOCKSIZE):
+        for text in decode_chunks([prefix], encoding, complete):
             pass
         return True
     except:
         return False
-    finally:
-        if f: f.close()
 
 
-def guess_charset(response, download):
+BOMS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+MATCH_META_CHARSET = re.compile('<meta.*charset=(")?([a-z0-9_-]+)[^a-z0-9_-]').search
+
+def charset_candidates(response, chunks):
+    """
+    Generates charsets for a body, most decisive signal first: a byte order
+    mark, the Content-Type header, a meta tag, and finally chardet. Later
+    candidates are only computed if earlier ones are rejected.
+    """
+    start = head(chunks, 4)
+    for (bom, charset) in BOMS:
+        if start.startswith(bom):
+            yield charset
+            break
+
     ctype = response.headers.get('content-type', '').lower()
     if 'charset=' in ctype:
-        charset = ctype.split('charset=')[-1]
-        if encoding_works(download, charset):
-            return charset
+        yield ctype.split('charset=')[-1].strip(' "\'')
 
-    s = codecs.open(download, encoding='ascii', errors='ignore').read(10000).lower()
-    mat_meta = re.compile('<meta.*charset=(")?([a-z0-9_-]+)[^a-z0-9_-]').search
-    m = mat_meta(s)
+    m = MATCH_META_CHARSET(head(chunks, 10000).decode('ascii', 'ignore').lower())
     if m:
-        charset = m.group(2)
-        if encoding_works(download, charset):
+        yield m.group(2)
+
+    detector = chardet.UniversalDetector()
+    n = 0
+    for c in chunks:
+        for i in range(0, len(c), 4096):
+            detector.feed(c[i:i+4096])
+            n += 4096
+            if detector.done or n >= CHARDET_BYTES:
+                break
+        if detector.done or n >= CHARDET_BYTES:
+            break
+    detector.close()
+    if detector.result['encoding']:
+        yield detector.result['encoding']
+
+
+def guess_charset(response, chunks, complete=True):
+    """
+    Returns the first candidate charset that decodes the first
+    CHARSET_CHECK_BYTES of the body, or utf-8.
+    """
+    prefix = head(chunks, CHARSET_CHECK_BYTES)
+    complete = complete and len(prefix) == sum(len(c) for c in chunks)
+    for charset in charset_candidates(response, chunks):
+        if encoding_works(prefix, charset, complete):
             return charset
+    return 'utf-8'
 
-    s = open(download, 'rb').read(ENCODING_DETECT_BYTES)
-    d = chardet.detect(s)
-    charset = d['encoding']
-    if charset and encoding_works(download, charset):
-        return charset
 
-    return 'utf-8'
+def url_extension(url):
+    name = urlparse.urlparse(url).path.rsplit('/', 1)[-1]
+    return name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+
+
+def text_kind(content_type, url):
+    """
+    Returns 'html', 'xml' or 'text' for a resource whose text can be
+    extracted, or None.
+    """
+    lurl = url.lower()
+    if 'html' in content_type or lurl.endswith('.html'):
+        return 'html'
+    elif 'xml' in content_type or lurl.endswith('.xml'):
+        return 'xml'
+    elif 'text/plain' in content_type or lurl.endswith('.txt'):
+        return 'text'
+    else:
+        return None
 
 
-TMP_DIR = ".tmp"
+def preflight_response(response, url):
+    """
+    Returns true if a response's headers show a text resource worth
+    downloading. Only the headers have been read at this point.
+    """
+    ctype = response.headers.get('content-type', '').split(';')[0].strip().lower()
+    if not text_kind(ctype, url):
+        return False
+    length = response.headers.get('content-length', '')
+    if length.isdigit() and int(length) > MAX_TEXT_CONTENT_LENGTH:
+        return False
+    return True
 
 
-def download_url(url):
+def download_url(url, max_bytes=None, text_only=False):
+    """
+    Downloads a url and returns its content type and its body decoded to
+    unicode. At most max_bytes of the body are read. Without a byte budget,
+    bodies longer than MAX_DOWNLOAD_BYTES are truncated with a warning.
+    If text_only is set, binary resources are skipped before their body is
+    requested or read, and their body is returned as None.
+    """
+    if text_only and url_extension(url) in BINARY_EXTS:
+        return (None, None)
+
     urlinfo = urlparse.urlparse(url)
 
     request = urllib2.Request(url)
@@ -68,67 +202,206 @@ def download_url(url):
         ('User-agent' , 'Mozilla/5.0'),
         ('Host' , urlinfo.netloc)
     ]
+    DOWNLOAD_LIMITER.wait(urlinfo.netloc)
     response = opener3.open(request, timeout=20.0)
+    try:
+        if text_only and not preflight_response(response, url):
+            return (response.headers.get('content-type', '').split(';')[0].strip(), None)
+        return read_response(response, max_bytes)
+    finally:
+        response.close()
 
-    if not os.path.isdir(TMP_DIR):
-        os.mkdir(TMP_DIR)
 
-    # write a temporary file in the original encoding
-    tmp = tempfile.mktemp(dir=TMP_DIR)
-    f = open(tmp, 'wb')
-    shutil.copyfileobj(response, f, BLOCKSIZE)
+def read_response(response, max_bytes=None):
     ctype = response.headers.get('content-type', '').split(';')[0].strip()
-    response.close()
-    f.close()
+    (chunks, complete) = read_body(response, max_bytes or MAX_DOWNLOAD_BYTES)
+    if not complete and not max_bytes:
+        warn('truncated download of %s to %d bytes' % (response.geturl(), MAX_DOWNLOAD_BYTES))
+    charset = guess_charset(response, chunks, complete)
+    # the charset was checked against a prefix, so bad bytes later on are replaced
+    body = u''.join(decode_chunks(chunks, charset, complete, 'replace'))
+    return (ctype, body)
 
-    charset = guess_charset(response, tmp)
 
-    tmp2 = tempfile.mktemp(dir=TMP_DIR)
-    reencode(tmp, charset, tmp2, 'utf-8')
+def url_to_text(url, max_bytes=None, max_chars=None, extractor=None):
+    """
+    Returns the visible text of a url, or None if it is not html, xml or
+    plain text. With a text budget, at most max_bytes of the page are
+    downloaded and at most max_chars of its text are returned. extractor
+    overrides TEXT_EXTRACTOR.
+    """
+    stream = (extractor or TEXT_EXTRACTOR) == 'stream'
+    (content_type, body) = download_url(url, max_bytes, text_only=True)
+    if body is None:
+        return None
+    kind = text_kind(content_type, url)
+    if kind == 'html':
+        if stream:
+            return stream_html_to_text(body, max_chars)
+        return html_to_text(body, max_chars)
+    elif kind == 'xml':
+        if stream:
+            return stream_xml_to_text(body, max_chars)
+        return xml_to_text(body, max_chars)
+    elif kind == 'text':
+        return text_to_text(body, max_chars)
+    else:
+        return None
 
-    f = gp_open(tmp2)
-    body = f.read()
-    f.close()
 
-    os.remove(tmp)
-    os.remove(tmp2)
+def join_text(strings, max_chars=None):
+    """
+    Joins strings with spaces, like BeautifulSoup's get_text(' '), but stops
+    taking strings once max_chars characters are reached.
+    """
+    parts = []
+    n = 0
+    for t in strings:
+        if max_chars is not None and n > max_chars:
+            break
+        parts.append(t)
+        n += len(t) + 1
+    text = u' '.join(parts)
+    return text if max_chars is None else text[:max_chars]
 
-    return (ctype, body)
 
+def html_to_text(html, max_chars=None):
+    soup = BeautifulSoup(html.encode('utf-8'), from_encoding='utf-8')
+    return join_text(soup.strings, max_chars)
 
-def reencode(src_path, src_encoding, dest_path, dest_encoding):
-    src_file = codecs.open(src_path, "r", src_encoding)
-    dest_file = codecs.open(dest_path, "w", dest_encoding)
-    shutil.copyfileobj(src_file, dest_file, BLOCKSIZE)
-    src_file.close()
-    dest_file.close()
 
+def text_to_text(txt, max_chars=None):
+    return txt if max_chars is None else txt[:max_chars]
 
-def url_to_text(url):
-    (content_type, body) = download_url(url)
-    lurl = url.lower()
-    if 'html' in content_type or lurl.endswith('.html'):
-        return html_to_text(body)
-    elif 'xml' in content_type or lurl.endswith('.xml'):
-        return xml_to_text(body)
-    elif 'text/plain' in content_type or lurl.endswith('.txt'):
-        return text_to_text(body)
-    else:
-        return None
 
+def xml_to_text(xml, max_chars=None):
+    soup = BeautifulSoup(xml.encode('utf-8'), 'xml', from_encoding='utf-8')
+    return join_text(soup.strings, max_chars)
 
-def html_to_text(html):
-    soup = BeautifulSoup(html.encode('utf-8'), from_encoding='utf-8')
-    return soup.get_text(' ')
 
+SKIPPED_TAGS = set(['script', 'style'])
+FEED_CHARS = 16*1024
 
-def text_to_text(txt):
-    return txt
 
+class _StopExtraction(Exception):
+    pass
 
-def xml_to_text(xml):
-    soup = BeautifulSoup(xml.encode('utf-8'), 'xml', from_encoding='utf-8')
-    return soup.get_text(' ')
+
+class TextCollector:
+    """
+    Collects the text nodes emitted by a streaming parser, skipping the
+    contents of SKIPPED_TAGS, until max_chars characters are collected.
+    Once the budget is full, data() raises _StopExtraction so that the
+    parser stops in the middle of whatever it is feeding.
+    """
+    def __init__(self, max_chars=None):
+        self.max_chars = max_chars
+        self.nodes = []
+        self.current = []
+        self.n = 0
+        self.current_n = 0
+        self.skipping = 0
+
+    def start(self, tag):
+        self.flush()
+        if tag.lower() in SKIPPED_TAGS:
+            self.skipping += 1
+
+    def end(self, tag):
+        self.flush()
+        if tag.lower() in SKIPPED_TAGS and self.skipping:
+            self.skipping -= 1
+
+    def data(self, text):
+        if not self.skipping:
+            if self.full():
+                raise _StopExtraction()
+            self.current.append(text)
+            self.current_n += len(text)
+
+    def flush(self):
+        if self.current:
+            node = u''.join(self.current)
+            self.nodes.append(node)
+            self.n += len(node) + 1
+            self.current = []
+            self.current_n = 0
+
+    def full(self):
+        return self.max_chars is not None and self.n + self.current_n > self.max_chars
+
+    def text(self):
+        self.flush()
+        return join_text(self.nodes, self.max_chars)
+
+
+class HtmlTextParser(HTMLParser):
+    def __init__(self, collector):
+        HTMLParser.__init__(self)
+        self.collector = collector
+
+    def handle_starttag(self, tag, attrs):
+        self.collector.start(tag)
+
+    def handle_endtag(self, tag):
+        self.collector.end(tag)
+
+    def handle_data(self, data):
+        self.collector.data(data)
+
+    def handle_entityref(self, name):
+        self.collector.data(self.unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        self.collector.data(self.unescape('&#%s;' % name))
+
+
+def stream_html_to_text(html, max_chars=None):
+    """
+    Extracts the visible text of an html page with a streaming tokenizer,
+    feeding it only as much of the page as the text budget needs.
+    """
+    collector = TextCollector(max_chars)
+    parser = HtmlTextParser(collector)
+    try:
+        for i in range(0, len(html), FEED_CHARS):
+            parser.feed(html[i:i+FEED_CHARS])
+            if collector.full():
+                break
+        else:
+            parser.close()
+    except (HTMLParseError, _StopExtraction):
+        pass    # keep the text before the error
+    return collector.text()
+
+
+def reject_entity_decl(*args):
+    # expat expands internal entities without limit, so a few nested
+    # declarations can expand into gigabytes of text
+    raise _StopExtraction()
+
+
+def stream_xml_to_text(xml, max_chars=None):
+    """
+    Extracts the text of an xml document with an expat event parser.
+    Documents that declare entities yield no text.
+    """
+    collector = TextCollector(max_chars)
+    parser = expat.ParserCreate('utf-8')
+    parser.StartElementHandler = lambda name, attrs: collector.start(name)
+    parser.EndElementHandler = collector.end
+    parser.CharacterDataHandler = collector.data
+    parser.EntityDeclHandler = reject_entity_decl
+    try:
+        for i in range(0, len(xml), FEED_CHARS):
+            parser.Parse(xml[i:i+FEED_CHARS].encode('utf-8'), False)
+            if collector.full():
+                break
+        else:
+            parser.Parse('', True)
+    except (expat.ExpatError, _StopExtraction):
+        pass    # keep the text before the error, as from a truncated download
+    return collector.text()
 
 
 def test_download_url():
@@ -139,4 +412,93 @@ def test_download_url():
 
 def test_url_to_text():
     text = url_to_text('http://www.shilad.com')
-    assert(text.strip().startswith('Shilad Sen'))
\ No newline at end of file
+    assert(text.strip().startswith('Shilad Sen'))
+
+
+class FakeResponse:
+    def __init__(self, body, content_type, content_length=None):
+        self.file = StringIO.StringIO(body)
+        self.headers = { 'content-type' : content_type }
+        if content_length is not None:
+            self.headers['content-length'] = str(content_length)
+
+    def read(self, n=-1):
+        return self.file.read(n)
+
+    def geturl(self):
+        return 'http://example.com/'
+
+def test_read_response():
+    html = u'<html><meta charset="iso-8859-1"><p>caf\xe9</p></html>'
+    r = read_response(FakeResponse(html.encode('iso-8859-1'), 'text/html'))
+    assert(r == ('text/html', html))
+    r = read_response(FakeResponse(html.encode('utf-8'), 'text/html; charset=UTF-8'))
+    assert(r == ('text/html', html))
+
+    # a multibyte character cut off by the size limit is dropped
+    (chunks, complete) = read_body(StringIO.StringIO(u'ab\xe9'.encode('utf-8')), 3)
+    assert(not complete)
+    assert(u''.join(decode_chunks(chunks, 'utf-8', complete)) == u'ab')
+
+def test_guess_charset():
+    latin1 = u'<html><meta charset="iso-8859-1"><p>caf\xe9</p></html>'.encode('iso-8859-1')
+    guess = lambda body, ctype='text/html': guess_charset(FakeResponse(body, ctype), [body])
+    assert(guess(latin1) == 'iso-8859-1')
+    assert(guess(latin1, 'text/html; charset="utf-8"') == 'iso-8859-1')
+    assert(guess(codecs.BOM_UTF8 + u'caf\xe9'.encode('utf-8'), 'text/plain; charset=utf-8') == 'utf-8-sig')
+    assert(guess(u'caf\xe9'.encode('utf-16')) == 'utf-16')
+
+    # only a prefix is checked, so invalid bytes beyond it are tolerated
+    body = 'a' * CHARSET_CHECK_BYTES + '\xff'
+    assert(guess(body, 'text/plain; charset=utf-8') == 'utf-8')
+    assert(read_response(FakeResponse(body, 'text/plain; charset=utf-8'))[1].endswith(u'a\ufffd'))
+
+def test_text_budget():
+    html = u'<html><head><title>t</title></head><body><p>one <b>two</b></p>three</body></html>'
+    soup = BeautifulSoup(html.encode('utf-8'), from_encoding='utf-8')
+    assert(html_to_text(html) == soup.get_text(' '))
+    for n in range(len(soup.get_text(' ')) + 2):
+        assert(html_to_text(html, n) == soup.get_text(' ')[:n])
+    assert(text_to_text(u'abcdef', 3) == u'abc')
+
+    body = u'<p>caf\xe9</p>'.encode('utf-8') * 1000
+    (ctype, text) = read_response(FakeResponse(body, 'text/html; charset=utf-8'), max_bytes=100)
+    assert(len(text) <= 100 and text.startswith(u'<p>caf\xe9</p>'))
+
+def test_stream_extractors():
+    html = (u'<html><head><title>A &amp; B</title><style>p { color: red }</style>'
+            u'<script>var x = "<p>no</p>";</script></head>'
+            u'<body><p>caf&eacute; &#233;t&#xe9;<br>one <b>two</b></p>three</body></html>')
+    assert(stream_html_to_text(html) == u'A & B caf\xe9 \xe9t\xe9 one  two three')
+    assert(stream_html_to_text(html, 8) == u'A & B ca')
+    assert(stream_html_to_text(html[:html.index('one')]) == u'A & B caf\xe9 \xe9t\xe9')
+
+    xml = u'<?xml version="1.0" encoding="iso-8859-1"?><doc><t>caf\xe9</t><t><![CDATA[a < b]]></t></doc>'
+    assert(stream_xml_to_text(xml) == u'caf\xe9 a < b')
+    assert(stream_xml_to_text(xml[:-10]) == u'caf\xe9 a < b')
+    assert(stream_xml_to_text(xml, 3) == u'caf')
+
+    # the budget holds within a single fed chunk
+    assert(stream_html_to_text(u'<p>' + u'x' * 100000, 10) == u'x' * 10)
+    assert(stream_xml_to_text(u'<t>' + u'x &amp; ' * 10000 + u'</t>', 10) == u'x & x & x ')
+
+    entities = u'<!ENTITY a "aaaaaaaaaa">'
+    for c in 'bcdefghi':
+        entities += u'<!ENTITY %s "%s">' % (c, (u'&%s;' % chr(ord(c) - 1)) * 10)
+    bomb = u'<?xml version="1.0"?><!DOCTYPE t [%s]><t>&i;</t>' % entities
+    assert(stream_xml_to_text(bomb, 10000) == u'')
+    assert(stream_xml_to_text(bomb) == u'')
+
+def test_preflight():
+    assert(url_extension('http://example.com/a/report.PDF?x=1') == 'pdf')
+    assert(url_extension('http://example.com/v1.2/') == '')
+    assert(download_url('http://example.invalid/scan.jpg', text_only=True) == (None, None))
+
+    ok = lambda ctype, url='http://example.com/a', length=None: \
+            preflight_response(FakeResponse('', ctype, length), url)
+    assert(ok('text/html; charset=utf-8'))
+    assert(ok('application/xhtml+xml'))
+    assert(ok('application/octet-stream', 'http://example.com/notes.txt'))
+    assert(not ok('application/pdf'))
+    assert(not ok('image/png'))
+    assert(not ok('text/html', length=MAX_TEXT_CONTENT_LENGTH + 1))
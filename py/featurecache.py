@@ -0,0 +1,507 @@
+"""
+Support for the tab-separated feature cache files kept by the providers.
+
+Each line of a cache file holds a key (a url or domain) and a value. The
+file is the source of truth, and providers append one line per newly
+resolved key. Rather than reopening the file for every line, a CacheWriter
+keeps the file open and writes buffered lines in groups. Buffered lines are
+written once max_lines are pending, by a timer at most max_delay seconds
+after they were buffered, and when the process exits. Only commit() forces the data
+to disk with fsync.
+
+Providers read their caches through one of two interchangeable backends,
+chosen with gputils.set_cache_backend():
+
+ - 'dict' loads the whole file into a dict. Lookups are fast, but startup
+   time and memory grow with the cache.
+ - 'sqlite' keeps an index of the file in path + '.sqlite' and answers
+   lookups from disk on demand, so startup is near-instant and pages are
+   shared between processes through the OS page cache. Lines appended to
+   the file since the index was last updated are indexed when it is opened.
+
+A RecordArchive keeps larger raw values, such as whois records, in an
+append-only file of zlib-compressed json, indexed by key through a
+feature cache of file offsets.
+"""
+
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from gputils import *
+
+
+class CacheWriter:
+    def __init__(self, path, max_lines=100, max_delay=5.0):
+        self.path = path
+        self.max_lines = max_lines
+        self.max_delay = max_delay
+        self.file = None
+        self.buffer = []
+        self.last_write = time.time()
+        self.listeners = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add_flush_listener(self, listener):
+        """
+        Calls listener() after each group of buffered lines is written.
+        """
+        with self.lock:
+            self.listeners.append(listener)
+
+    def write(self, line):
+        with self.lock:
+            self.buffer.append(line + u'\n')
+            if (len(self.buffer) >= self.max_lines
+            or time.time() - self.last_write >= self.max_delay):
+                self._write_buffer()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.max_delay, self._flush_on_timer)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _flush_on_timer(self):
+        with self.lock:
+            self.timer = None
+            self._write_buffer()
+
+    def flush(self):
+        with self.lock:
+            self._write_buffer()
+
+    def commit(self):
+        with self.lock:
+            self._write_buffer()
+            if self.file:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            self._write_buffer()
+            if self.file:
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+    def _write_buffer(self):
+        if self.buffer:
+            if not self.file:
+                self.file = gp_open(self.path, 'a')
+            self.file.write(u''.join(self.buffer))
+            self.file.flush()
+            self.buffer = []
+            for listener in self.listeners:
+                listener()
+        self.last_write = time.time()
+
+
+WRITERS = {}
+WRITERS_LOCK = threading.Lock()
+
+def get_cache_writer(path):
+    """
+    Returns the CacheWriter shared by everything appending to path.
+    """
+    key = os.path.abspath(path)
+    with WRITERS_LOCK:
+        if key not in WRITERS:
+            WRITERS[key] = CacheWriter(path)
+        return WRITERS[key]
+
+def commit_cache_writers():
+    with WRITERS_LOCK:
+        writers = list(WRITERS.values())
+    for w in writers:
+        w.commit()
+
+def close_cache_writers():
+    with WRITERS_LOCK:
+        writers = list(WRITERS.values())
+        WRITERS.clear()
+    for w in writers:
+        w.close()
+
+atexit.register(close_cache_writers)
+
+
+# Returned by a cache's decode function for lines that should be ignored.
+SKIP = object()
+
+def split_cache_line(line):
+    tokens = line.split('\t')
+    if len(tokens) != 2:
+        return None
+    return (tokens[0].strip(), tokens[1].strip())
+
+
+class DictCache:
+    def __init__(self, path, decode, name='feature'):
+        self.path = path
+        self.decode = decode
+        self.writer = get_cache_writer(path)
+        self.writer.flush()
+        self.entries = {}
+
+        warn('reading %s results...' % name)
+        n = 0
+        f = gp_open(path)
+        for line in f:
+            pair = split_cache_line(line)
+            if pair:
+                value = decode(pair[1])
+                if value is not SKIP:
+                    self.entries[pair[0]] = value
+                n += 1
+            else:
+                warn('invalid %s line: %s' % (name, `line`))
+        f.close()
+        warn('finished reading %d %s entries' % (n, name))
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    def put(self, key, raw):
+        """
+        Records the raw value for a key and appends it to the cache file.
+        """
+        value = self.decode(raw)
+        if value is not SKIP:
+            self.entries[key] = value
+        self.writer.write(key + u'\t' + raw)
+
+    def remember(self, key, value):
+        """
+        Records a decoded value for a key for the life of this process only.
+        """
+        self.entries[key] = value
+
+
+class SqliteCache:
+    def __init__(self, path, decode, name='feature'):
+        self.path = path
+        self.decode = decode
+        self.writer = get_cache_writer(path)
+        self.writer.flush()
+        self.memory = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        # The file is the source of truth, so the index does not need to be
+        # durable. Transactions are begun explicitly (isolation_level=None).
+        self.db = sqlite3.connect(path + '.sqlite', timeout=60.0, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('pragma synchronous = off')
+        self.db.execute('create table if not exists entries (key text primary key, value text)')
+        self.db.execute('create table if not exists meta (name text primary key, value integer)')
+        self.indexed = self.update_index(name)
+
+        # new entries reach the index in one transaction each time the writer flushes
+        self.writer.add_flush_listener(self.flush_pending)
+
+    def indexed_offset(self):
+        row = self.db.execute("select value from meta where name = 'offset'").fetchone()
+        return row[0] if row else 0
+
+    def update_index(self, name):
+        """
+        Indexes the lines appended to the file since the index was updated,
+        and returns how many this process indexed.
+        Each batch of lines is committed along with the new offset, under a
+        write lock that is held from the moment the offset is read, so
+        processes opening the same cache at once share the work.
+        """
+        size = os.path.getsize(self.path)
+        if self.indexed_offset() == size:
+            return 0
+
+        warn('indexing %s results...' % name)
+        n = 0
+        f = open(self.path, 'rb')
+        try:
+            while True:
+                self.db.execute('begin immediate')
+                try:
+                    offset = self.indexed_offset()
+                    if offset > size:
+                        warn('%s shrank; rebuilding its index' % self.path)
+                        self.db.execute('delete from entries')
+                        offset = 0
+                    f.seek(offset)
+                    start = offset
+                    batch = []
+                    for line in f:
+                        if not line.endswith('\n'):
+                            break   # a partially written last line
+                        offset += len(line)
+                        pair = split_cache_line(line.decode('utf-8'))
+                        if pair:
+                            batch.append(pair)
+                        else:
+                            warn('invalid %s line: %s' % (name, `line`))
+                        if len(batch) >= 10000:
+                            break
+                    self.db.executemany('insert or replace into entries values (?, ?)', batch)
+                    self.db.execute("insert or replace into meta values ('offset', ?)", (offset,))
+                    self.db.execute('commit')
+                except:
+                    self.db.execute('rollback')
+                    raise
+                n += len(batch)
+                if offset == start:
+                    break
+        finally:
+            f.close()
+        warn('finished indexing %d %s entries' % (n, name))
+        return n
+
+    def flush_pending(self):
+        with self.lock:
+            if not self.pending:
+                return
+            items = self.pending.items()
+            self.db.execute('begin immediate')
+            try:
+                self.db.executemany('insert or replace into entries values (?, ?)', items)
+                self.db.execute('commit')
+            except:
+                self.db.execute('rollback')
+                raise
+            self.pending = {}
+
+    def lookup(self, key):
+        if key in self.memory:
+            return self.memory[key]
+        if type(key) == str:
+            key = key.decode('utf-8', 'replace')
+        with self.lock:
+            if key in self.pending:
+                return self.decode(self.pending[key])
+            row = self.db.execute('select value from entries where key = ?', (key,)).fetchone()
+        if row is None:
+            return SKIP
+        return self.decode(row[0])
+
+    def __contains__(self, key):
+        return self.lookup(key) is not SKIP
+
+    def get(self, key, default=None):
+        value = self.lookup(key)
+        return default if value is SKIP else value
+
+    def put(self, key, raw):
+        self.memory.pop(key, None)
+        if type(key) == str:
+            key = key.decode('utf-8', 'replace')
+        with self.lock:
+            self.pending[key] = raw
+        self.writer.write(key + u'\t' + raw)
+
+    def remember(self, key, value):
+        self.memory[key] = value
+
+
+def open_feature_cache(path, decode, name='feature'):
+    """
+    Opens a feature cache file with the configured backend. decode turns
+    the raw value column into the value returned by get(), or SKIP.
+    """
+    backend = get_cache_backend()
+    if backend == 'dict':
+        return DictCache(path, decode, name)
+    elif backend == 'sqlite':
+        return SqliteCache(path, decode, name)
+    else:
+        raise GPException('unknown cache backend: %s' % backend)
+
+
+class RecordArchive:
+    """
+    An append-only archive of compressed json values with random access by
+    key. Each record in the data file is a "key<TAB>length" line followed
+    by length bytes of compressed json. The index at path + '.idx.tsv' maps
+    keys to the offsets of their latest records. Only one process should
+    append to an archive at a time.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx.tsv'
+        for p in (self.path, self.index_path):
+            if not os.path.isfile(p):
+                open(p, 'a').close()
+        self.index = open_feature_cache(self.index_path, decode_archive_offset, 'archive index')
+        self.lock = threading.Lock()
+        self.file = open(self.path, 'a+b')
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def put(self, key, value):
+        blob = zlib.compress(json.dumps(value))
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(('%s\t%d\n' % (key, len(blob))).encode('utf-8'))
+            offset = self.file.tell()
+            self.file.write(blob)
+            self.file.flush()
+        self.index.put(key, u'%d,%d' % (offset, len(blob)))
+
+    def get(self, key, default=None):
+        location = self.index.get(key)
+        if not location:
+            return default
+        (offset, length) = location
+        with self.lock:
+            self.file.seek(offset)
+            blob = self.file.read(length)
+        return json.loads(zlib.decompress(blob))
+
+    def scan(self):
+        """
+        Generates (key, value) pairs for every record in the archive, in the
+        order they were written. A key appears once for each time it was put.
+        """
+        f = open(self.path, 'rb')
+        try:
+            while True:
+                header = f.readline()
+                if not header.endswith('\n'):
+                    break
+                (key, length) = header.decode('utf-8').rstrip('\n').split('\t')
+                blob = f.read(int(length))
+                if len(blob) < int(length):
+                    break   # a partially written last record
+                yield (key, json.loads(zlib.decompress(blob)))
+        finally:
+            f.close()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def decode_archive_offset(value):
+    (offset, length) = value.split(',')
+    return (int(offset), int(length))
+
+
+def test_cache_writer():
+    import tempfile
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        writer = CacheWriter(path, max_lines=2, max_delay=1000.0)
+        writer.write(u'a\t1')
+        assert(open(path).read() == '')
+        writer.write(u'b\t2')
+        assert(open(path).read() == 'a\t1\nb\t2\n')
+        writer.write(u'c\t3')
+        writer.commit()
+        assert(open(path).read() == 'a\t1\nb\t2\nc\t3\n')
+        writer.close()
+        assert(get_cache_writer(path) is get_cache_writer(path))
+
+        # a few lines followed by an idle period are written by the timer
+        writer = CacheWriter(path, max_lines=100, max_delay=0.1)
+        writer.write(u'd\t4')
+        assert(open(path).read().count('\n') == 3)
+        time.sleep(0.3)
+        assert(open(path).read().endswith('c\t3\nd\t4\n'))
+        writer.close()
+    finally:
+        close_cache_writers()
+        os.remove(path)
+
+def test_record_archive():
+    import shutil
+    import tempfile
+    dir = tempfile.mkdtemp()
+    try:
+        archive = RecordArchive(dir + '/raw')
+        archive.put('a.com', [u'record a'])
+        archive.put(u'b.org', [u'record b', u'caf\xe9'])
+        archive.put('a.com', [u'record a2'])
+        assert(archive.get('a.com') == [u'record a2'])
+        assert(archive.get('b.org') == [u'record b', u'caf\xe9'])
+        assert('c.net' not in archive and archive.get('c.net') is None)
+        archive.close()
+        close_cache_writers()
+
+        archive = RecordArchive(dir + '/raw')
+        assert(archive.get('b.org') == [u'record b', u'caf\xe9'])
+        assert([k for (k, v) in archive.scan()] == ['a.com', 'b.org', 'a.com'])
+        archive.close()
+    finally:
+        close_cache_writers()
+        shutil.rmtree(dir)
+
+def test_caches():
+    import tempfile
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    f = open(path, 'w')
+    f.write('a\t1\nb\t\nc\t2\nbad line\nc\t3\n')
+    f.close()
+    decode = lambda v: int(v) if v else SKIP
+    try:
+        for cache_class in (DictCache, SqliteCache):
+            cache = cache_class(path, decode)
+            assert('a' in cache and cache.get('a') == 1)
+            assert('b' not in cache and cache.get('b') is None)
+            assert(cache.get('c') == 3)
+            cache.put('d', u'4')
+            cache.remember('e', 5)
+            assert(cache.get('d') == 4 and cache.get('e') == 5)
+            close_cache_writers()
+
+        # lines appended since the index was built are picked up on reopening
+        cache = SqliteCache(path, decode)
+        assert(cache.get('d') == 4 and cache.get('e') is None)
+        assert(len([l for l in open(path) if l.startswith('d')]) == 2)
+    finally:
+        close_cache_writers()
+        os.remove(path)
+        if os.path.isfile(path + '.sqlite'):
+            os.remove(path + '.sqlite')
+
+def open_sqlite_cache(path):
+    return SqliteCache(path, lambda v: v).indexed
+
+def test_sqlite_cache_concurrency():
+    import multiprocessing
+    import tempfile
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    f = open(path, 'w')
+    for i in range(50000):
+        f.write('k%d\t%d\n' % (i, i))
+    f.close()
+    try:
+        # processes opening a fresh cache at once split the indexing between them
+        pool = multiprocessing.Pool(3)
+        counts = pool.map(open_sqlite_cache, [path] * 3)
+        pool.close()
+        pool.join()
+        assert(sum(counts) == 50000)
+
+        # puts reach the index when the writer flushes
+        cache = SqliteCache(path, lambda v: v)
+        assert(cache.indexed == 0)
+        cache.put('new', u'1')
+        indexed = lambda: cache.db.execute("select count(*) from entries where key = 'new'").fetchone()[0]
+        assert(cache.get('new') == u'1' and indexed() == 0)
+        cache.writer.flush()
+        assert(indexed() == 1)
+    finally:
+        close_cache_writers()
+        os.remove(path)
+        os.remove(path + '.sqlite')
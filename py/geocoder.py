@@ -0,0 +1,193 @@
+"""
+An offline reverse geocoder that maps coordinates to countries.
+
+Country boundaries are read from a GeoJSON FeatureCollection, such as
+Natural Earth's admin 0 countries, placed at data/countries.geojson. Each
+feature needs an ISO 3166-1 alpha-2 code in one of its properties (see
+CODE_PROPERTIES). Polygons are registered in a grid of one degree cells
+covering their bounding boxes, so a lookup only runs point-in-polygon
+tests against the few polygons near the point.
+
+"""
+
+import json
+import math
+import os
+
+import numpy
+
+from gputils import *
+
+
+# properties that may hold a feature's two letter country code, in order of preference
+CODE_PROPERTIES = ['ISO_A2_EH', 'ISO_A2', 'iso_a2', 'ISO3166-1-Alpha-2', 'iso_3166_1_alpha_2']
+
+CELL_SIZE = 1.0
+
+
+class CountryPolygon:
+    def __init__(self, code, rings):
+        self.code = code
+        self.rings = [numpy.array(r, dtype=float)[:, :2] for r in rings if len(r) >= 3]
+        points = numpy.vstack(self.rings)
+        (self.min_lng, self.min_lat) = points.min(axis=0)
+        (self.max_lng, self.max_lat) = points.max(axis=0)
+
+    def bbox_contains(self, lngs, lats):
+        return ((lngs >= self.min_lng) & (lngs <= self.max_lng)
+              & (lats >= self.min_lat) & (lats <= self.max_lat))
+
+    def contains(self, lngs, lats):
+        """
+        Returns a boolean array telling which points are inside the polygon.
+        Holes are handled by the even-odd rule across all rings.
+        """
+        inside = numpy.zeros(len(lngs), dtype=bool)
+        for ring in self.rings:
+            inside ^= points_in_ring(ring, lngs, lats)
+        return inside
+
+
+def points_in_ring(ring, xs, ys):
+    """
+    Ray casting test of points against one closed ring, vectorized over
+    the ring's edges and over chunks of points.
+    """
+    (x1, y1) = (ring[:, 0], ring[:, 1])
+    (x2, y2) = (numpy.roll(x1, -1), numpy.roll(y1, -1))
+    inside = numpy.zeros(len(xs), dtype=bool)
+    step = max(1, 200000 // len(ring))
+    for i in range(0, len(xs), step):
+        px = xs[i:i+step, None]
+        py = ys[i:i+step, None]
+        straddles = (y1 > py) != (y2 > py)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            crossing = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+            inside[i:i+step] = (straddles & (px < crossing)).sum(axis=1) % 2 == 1
+    return inside
+
+
+def feature_code(feature):
+    props = feature.get('properties') or {}
+    for p in CODE_PROPERTIES:
+        code = props.get(p)
+        if code and len(code) == 2 and code.isalpha():
+            return code.lower()
+    return None
+
+
+class CountryGeocoder:
+    def __init__(self, path=None):
+        if not path: path = get_data_path('countries.geojson')
+        f = open(path)
+        collection = json.load(f)
+        f.close()
+
+        self.polygons = []
+        for feature in collection['features']:
+            code = feature_code(feature)
+            geometry = feature.get('geometry')
+            if not code or not geometry:
+                continue
+            if geometry['type'] == 'Polygon':
+                parts = [geometry['coordinates']]
+            elif geometry['type'] == 'MultiPolygon':
+                parts = geometry['coordinates']
+            else:
+                continue
+            for rings in parts:
+                if rings and len(rings[0]) >= 3:
+                    self.polygons.append(CountryPolygon(code, rings))
+
+        self.grid = {}
+        for (i, p) in enumerate(self.polygons):
+            for x in range(cell(p.min_lng), cell(p.max_lng) + 1):
+                for y in range(cell(p.min_lat), cell(p.max_lat) + 1):
+                    self.grid.setdefault((x, y), []).append(i)
+        warn('read %d country polygons from %s' % (len(self.polygons), path))
+
+    def country_at(self, lat, lng):
+        """
+        Returns the lowercase country code at a coordinate, or None.
+        """
+        lngs = numpy.array([lng], dtype=float)
+        lats = numpy.array([lat], dtype=float)
+        for i in self.grid.get((cell(lng), cell(lat)), []):
+            p = self.polygons[i]
+            if p.bbox_contains(lngs, lats)[0] and p.contains(lngs, lats)[0]:
+                return p.code
+        return None
+
+    def countries_at(self, lats, lngs):
+        """
+        Resolves many coordinates in one pass over the polygons. Returns a
+        list with the country code at each coordinate, or None.
+        """
+        lats = numpy.asarray(lats, dtype=float)
+        lngs = numpy.asarray(lngs, dtype=float)
+        result = [None] * len(lats)
+        unresolved = numpy.ones(len(lats), dtype=bool)
+        for p in self.polygons:
+            candidates = numpy.nonzero(unresolved & p.bbox_contains(lngs, lats))[0]
+            if len(candidates) == 0:
+                continue
+            hits = candidates[p.contains(lngs[candidates], lats[candidates])]
+            for j in hits:
+                result[j] = p.code
+            unresolved[hits] = False
+        return result
+
+
+def cell(degrees):
+    return int(math.floor(degrees / CELL_SIZE))
+
+
+GEOCODER_INST = None
+
+def get_geocoder():
+    """
+    Returns the shared CountryGeocoder, or None if no boundary file exists.
+    """
+    global GEOCODER_INST
+    if GEOCODER_INST is None:
+        path = get_data_path('countries.geojson')
+        GEOCODER_INST = CountryGeocoder(path) if os.path.isfile(path) else False
+    return GEOCODER_INST or None
+
+
+def test_geocoder():
+    import tempfile
+    square = lambda x, y, s: [[x, y], [x + s, y], [x + s, y + s], [x, y + s], [x, y]]
+    collection = {
+        'type' : 'FeatureCollection',
+        'features' : [
+            # a country with a hole for an enclave
+            { 'properties' : { 'ISO_A2' : 'IT' },
+              'geometry' : { 'type' : 'Polygon', 'coordinates' : [square(0, 0, 10), square(4, 4, 2)] } },
+            { 'properties' : { 'ISO_A2' : 'SM' },
+              'geometry' : { 'type' : 'Polygon', 'coordinates' : [square(4, 4, 2)] } },
+            # a country split across polygons, the second one south of the equator
+            { 'properties' : { 'ISO_A2' : '-99', 'ISO_A2_EH' : 'FR' },
+              'geometry' : { 'type' : 'MultiPolygon', 'coordinates' : [[square(20, 0, 5)], [[[-60, -10], [-50, -10], [-55, -2], [-60, -10]]]] } },
+            { 'properties' : { 'name' : 'no code' },
+              'geometry' : { 'type' : 'Polygon', 'coordinates' : [square(-100, -100, 200)] } },
+        ]
+    }
+    (fd, path) = tempfile.mkstemp(suffix='.geojson')
+    os.close(fd)
+    try:
+        f = open(path, 'w')
+        json.dump(collection, f)
+        f.close()
+        geocoder = CountryGeocoder(path)
+    finally:
+        os.remove(path)
+
+    assert(len(geocoder.polygons) == 4)
+    coords = [(1.5, 1.5, 'it'), (5.0, 5.0, 'sm'), (9.9, 0.1, 'it'), (2.0, 22.0, 'fr'),
+              (-5.0, -55.0, 'fr'), (-3.0, -51.0, None), (50.0, 50.0, None)]
+    for (lat, lng, code) in coords:
+        assert(geocoder.country_at(lat, lng) == code)
+    lats = [c[0] for c in coords]
+    lngs = [c[1] for c in coords]
+    assert(geocoder.countries_at(lats, lngs) == [c[2] for c in coords])
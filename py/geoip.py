@@ -11,6 +11,9 @@ import urllib
 import os
 
 from gputils import *
+from featurecache import open_feature_cache
+
+GEOIP_LIMITER = RateLimiter(0.4)
 
 class GeoIpProvider:
     def __init__(self, path=None):
@@ -18,38 +21,25 @@ class GeoIpProvider:
         if not self.cache_path: self.cache_path = get_feature_data_path('geoip')
         if not os.path.isfile(self.cache_path):
             raise GPException('geoip results not available...')
+        self.domains = open_feature_cache(self.cache_path, lambda iso: iso, 'geoip')
 
-        warn('reading geoip results...')
-        n = 0
-        self.domains = {}
-        for line in gp_open(self.cache_path):
-            tokens = line.strip().split('\t')
-            if len(tokens) == 2:
-                domain = tokens[0]
-                iso = tokens[1]
-                self.domains[domain] = iso
-                n += 1
-            else:
-                warn('invalid geoip line: %s' % `line`)
-        warn('finished reading %d geoip entries' % n)
+    def is_cached(self, url):
+        return get_url_info(url).registered_domain in self.domains
 
     def get(self, url):
-        d = url2registereddomain(url)
+        d = get_url_info(url).registered_domain
         if d not in self.domains:
             c = geocode_url(url)
             if c:
-                self.add_cache_line(d + u'\t' + c + u'\n')
-            self.domains[d] = c
+                self.domains.put(d, c)
+            else:
+                self.domains.remember(d, None)
         return self.domains.get(d)
 
-    def add_cache_line(self, line):
-        f = gp_open(self.cache_path, 'a')
-        f.write(line + u'\n')
-        f.close()
-
 def geocode_url(url):
     h = url2host(url)
     try:
+        GEOIP_LIMITER.wait()
         s = urllib.urlopen('http://freegeoip.net/csv/' + h).read()
         tokens = s.split(',')
         if len(tokens) > 2 and len(tokens[1]) == 2:
@@ -70,6 +60,9 @@ class GeoIPFeature:
         if not provider: provider = GeoIpProvider()
         self.provider = provider
         self.name = 'geoip'
+        self.domain_only = True
+        self.cost = 2
+        self.service = 'geoip'
 
     def infer(self, url):
         if self.provider.contains(url):
@@ -77,6 +70,9 @@ class GeoIPFeature:
         else:
             return (0, {})
 
+    def is_cached(self, url):
+        return self.provider.is_cached(url)
+
 
 def test_geoip():
     provider = GeoIpProvider()
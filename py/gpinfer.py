@@ -1,10 +1,12 @@
 #!/usr/bin/python -O
 
-import collections
 import math
 
+import numpy
+
 from gputils import *
-from country import read_countries
+from country import read_countries, get_country_index
+from lookup import LookupEngine
 # from geoip import GeoIPFeature
 from milgov import MilGovFeature
 from pagelang import PagelangsFeature
@@ -18,15 +20,21 @@ class PriorFeature:
     def __init__(self, countries=None):
         if not countries: countries = read_countries()
         self.name = 'prior'
+        self.domain_only = True
+        self.cost = 0
         self.prior = {}
         for c in countries:
             self.prior[c.iso] = c.prior
         if len(self.prior) == 0:
             raise Exception('no country priors!')
+        self.prior_values = get_country_index().dense(self.prior)
 
     def infer(self, url):
         return (0.2, dict(self.prior))
 
+    def infer_array(self, url):
+        return (0.2, self.prior_values)
+
 
 def logit(p):
     return math.log(p) - math.log(1 - p)
@@ -39,7 +47,24 @@ def logistic(x):
     return 1.0 / (1 + math.exp(-x))
 
 class LogisticInferrer:
-    def __init__(self, features=None, intercept=None, coefficients=None):
+    """
+    Combines the features' country distributions with a logistic model.
+
+    Most features depend only on a url's host or registered domain. The
+    intercept plus the weighted sum of those features is kept per domain in
+    an LRU cache of domain_cache_size entries, so urls from a domain that
+    was already seen only need the url-dependent features (pagelang).
+
+    In lazy mode, features are evaluated from cheapest to most expensive
+    according to their cost (0 = computed, 2 and up = network lookups) and
+    whether their answer is already cached. Before each expensive lookup,
+    the largest swing the remaining features could cause is computed. If
+    they cannot change the most likely country, and cannot move its
+    probability by more than lazy_tolerance, they are skipped and treated
+    as uninformative. The default tolerance of 1.0 only checks the argmax.
+    """
+    def __init__(self, features=None, intercept=None, coefficients=None, domain_cache_size=10000,
+                 lazy=False, lazy_tolerance=1.0):
         self.name = 'logistic'
         self.reg = None
         if not features:
@@ -62,6 +87,14 @@ class LogisticInferrer:
             self.intercept = intercept
             self.coefficients = coefficients
         self.countries = read_countries()
+        self.index = get_country_index()
+        self.domain_cache = LruCache(domain_cache_size)
+        self.domain_features = [i for (i, f) in enumerate(self.features) if getattr(f, 'domain_only', False)]
+        self.url_features = [i for (i, f) in enumerate(self.features) if not getattr(f, 'domain_only', False)]
+        self.lazy = lazy
+        self.lazy_tolerance = lazy_tolerance
+        self.lazy_skips = 0
+        self.lookup_engine = None
 
     def get_feature(self, name):
         for f in self.features:
@@ -69,19 +102,41 @@ class LogisticInferrer:
                 return f
         return None
 
-    def make_rows(self, url_info):
-        rows = collections.defaultdict(list)
+    def feature_values(self, f, url_info):
+        """
+        Returns a (conf, values) pair for a feature, where values is None,
+        a sparse (index array, value array) pair, or a dense float array
+        aligned with the country index. Features that only know how to
+        produce dicts are converted here.
+        """
+        if hasattr(f, 'infer_array'):
+            return f.infer_array(url_info)
+        (conf, dist) = f.infer(url_info)
+        if not dist:
+            return (conf, None)
+        return (conf, self.index.sparse(dist))
 
-        for f in self.features:
-            (conf, dist) = f.infer(url_info)
-            if dist:
-                for c in self.countries:
-                    rows[c.iso].append(dist.get(c.iso, 0.0))
+    def fill_feature(self, row, conf, values):
+        if conf > 0 and values is not None:
+            if type(values) == tuple:
+                (indexes, probs) = values
+                row[indexes] = probs
             else:
-                for c in self.countries:
-                    rows[c.iso].append(1.0 / len(self.countries))
+                row[:] = values
+        else:
+            row[:] = 1.0 / len(self.index)
 
-        return rows
+    def make_rows(self, url_info):
+        """
+        Returns a country x feature array of feature values for a url,
+        with rows ordered as in the country index.
+        """
+        url_info = get_url_info(url_info)
+        rows = numpy.zeros((len(self.features), len(self.index)))
+        for (i, f) in enumerate(self.features):
+            (conf, values) = self.feature_values(f, url_info)
+            self.fill_feature(rows[i], conf, values)
+        return rows.T
 
 
     def train(self, data):
@@ -92,9 +147,9 @@ class LogisticInferrer:
 
         for (urlinfo, actual) in data:
             rows = self.make_rows(urlinfo)
-            for c in self.countries:
-                Y.append(1 if c.iso == actual else 0)
-                X.append(rows[c.iso])
+            for (i, iso) in enumerate(self.index.isos):
+                Y.append(1 if iso == actual else 0)
+                X.append(rows[i])
 
         self.reg = LogisticRegression()
         self.reg.fit(X, Y)
@@ -105,6 +160,7 @@ class LogisticInferrer:
 
         self.intercept = self.reg.intercept_[0]
         self.coefficients = self.reg.coef_[0]
+        self.domain_cache.clear()
 
     def get_equation(self):
         eq = '%.2f' % self.reg.intercept_
@@ -112,32 +168,264 @@ class LogisticInferrer:
             eq += ' + %.2f * %s' % (self.reg.coef_[0][i], f.name)
         return eq
 
+    def get_cache_stats(self):
+        return {
+            'hits' : self.domain_cache.hits,
+            'misses' : self.domain_cache.misses,
+            'size' : len(self.domain_cache),
+            'lazy_skips' : self.lazy_skips,
+        }
+
+    def feature_cost(self, f, url_info):
+        cost = getattr(f, 'cost', 0)
+        if cost > 1 and hasattr(f, 'is_cached') and f.is_cached(url_info):
+            cost = 1
+        return cost
+
+    def is_settled(self, scores, remaining):
+        """
+        Returns true if features with the remaining coefficients can neither
+        change the argmax of the scores nor move its probability by more
+        than the lazy tolerance. Each remaining feature adds between
+        min(0, coef) and max(0, coef) to the score of every country.
+        """
+        lo = sum(min(0.0, c) for c in remaining)
+        hi = sum(max(0.0, c) for c in remaining)
+        top = numpy.argmax(scores)
+        others = numpy.delete(scores, top)
+        if len(others) == 0:
+            return True
+        if scores[top] + lo <= others.max() + hi:
+            return False
+        if self.lazy_tolerance >= 1.0:
+            return True
+
+        g = lambda s: (1.0 / (1.0 + numpy.exp(-s))) ** 1.2
+        top_hi = g(scores[top] + hi)
+        top_lo = g(scores[top] + lo)
+        p_hi = top_hi / (top_hi + g(others + lo).sum())
+        p_lo = top_lo / (top_lo + g(others + hi).sum())
+        return p_hi - p_lo <= self.lazy_tolerance
+
+    def lazy_scores(self, url_info):
+        """
+        Computes the scores for a url, skipping expensive features whose
+        outcome cannot matter. Domain scores are reused if cached, and are
+        added to the domain cache when every domain feature was evaluated.
+        """
+        n = len(self.index)
+        key = (url_info.registered_domain or url_info.host, url_info.tld)
+        scores = self.domain_cache.get(key)
+        if scores is not None:
+            scores = scores.copy()
+            domain = None
+            remaining = list(self.url_features)
+        else:
+            scores = numpy.zeros(n) + self.intercept
+            domain = scores.copy()
+            remaining = range(len(self.features))
+        remaining.sort(key=lambda i: self.feature_cost(self.features[i], url_info))
+
+        row = numpy.zeros(n)
+        skipped = []
+        for (pos, i) in enumerate(remaining):
+            f = self.features[i]
+            if self.feature_cost(f, url_info) > 1:
+                rest = [self.coefficients[j] for j in remaining[pos:]]
+                if self.is_settled(scores, rest):
+                    self.lazy_skips += len(rest)
+                    scores += sum(rest) / n
+                    skipped = remaining[pos:]
+                    break
+            (conf, values) = self.feature_values(f, url_info)
+            self.fill_feature(row, conf, values)
+            scores += self.coefficients[i] * row
+            if domain is not None and i in self.domain_features:
+                domain += self.coefficients[i] * row
+            row[:] = 0.0
+        if domain is not None and not any(i in self.domain_features for i in skipped):
+            self.domain_cache.put(key, domain)
+        return scores
+
+    def domain_scores(self, url_info):
+        """
+        Returns the intercept plus the weighted domain-only features for
+        each country, consulting the domain cache first. The host's tld is
+        part of the key because the tld and mil features read the host.
+        """
+        key = (url_info.registered_domain or url_info.host, url_info.tld)
+        scores = self.domain_cache.get(key)
+        if scores is None:
+            row = numpy.zeros(len(self.index))
+            scores = numpy.zeros(len(self.index)) + self.intercept
+            for i in self.domain_features:
+                (conf, values) = self.feature_values(self.features[i], url_info)
+                self.fill_feature(row, conf, values)
+                scores += self.coefficients[i] * row
+                row[:] = 0.0
+            self.domain_cache.put(key, scores)
+        return scores
+
     def infer(self, url_info):
-        result = {}
+        return self.infer_batch([url_info], raise_errors=True)[0]
 
-        for c in self.countries:
-            result[c.iso] = self.intercept
-        for (i, f) in enumerate(self.features):
-            (conf, dist) = f.infer(url_info)
-            if conf > 0 and dist:
-                for c in dist:
-                    c2 = u'gb' if c == u'uk' else c
-                    result[c2] += self.coefficients[i] * dist[c]
-            else:
-                for c in result:
-                    result[c] += self.coefficients[i] * 1.0 / len(result)
+    def infer_async(self, url_info):
+        """
+        Starts the network lookups for a url concurrently with those of
+        other urls and returns a pending result whose get() method returns
+        the (conf, dist) pair. See the lookup module.
+        """
+        if not self.lookup_engine:
+            self.lookup_engine = LookupEngine(self)
+        return self.lookup_engine.submit(url_info)
+
+    def infer_batch(self, urls, raise_errors=False):
+        """
+        Infers the country distributions for a sequence of urls at once.
+        Returns a list of (conf, dist) pairs in the same order as urls.
+        If a feature fails for a url, the error is logged and the url's
+        entry is None, unless raise_errors is set.
+
+        Feature values are stacked into a url x feature x country tensor
+        so that the linear model, logistic, and calibration are applied as
+        array operations rather than one country at a time.
+
+        Each url is parsed once into a UrlInfo that is shared by all features.
+        """
+        base = numpy.zeros((len(urls), len(self.index)))
+        X = numpy.zeros((len(urls), len(self.url_features), len(self.index)))
+        failed = set()
+        for (u, url) in enumerate(urls):
+            try:
+                url_info = get_url_info(url)
+                if self.lazy:
+                    base[u] = self.lazy_scores(url_info)
+                    continue
+                base[u] = self.domain_scores(url_info)
+                for (j, i) in enumerate(self.url_features):
+                    (conf, values) = self.feature_values(self.features[i], url_info)
+                    self.fill_feature(X[u, j], conf, values)
+            except:
+                if raise_errors:
+                    raise
+                warn('inference for %s failed: %s' % (getattr(url, 'url', url), sys.exc_info()[1]))
+                failed.add(u)
+
+        coefficients = numpy.asarray(self.coefficients, dtype=float)[self.url_features]
+        scores = base + numpy.dot(X.transpose(0, 2, 1), coefficients)
 
         # the raising to 1.2nd power approximately calibrates
         # output probabilities to 85% for correct and 66% for incorrect,
         # but does not affect evaluation accuracy
-        for (c, score) in result.items():
-            result[c] = logistic(score) ** 1.2
+        probs = (1.0 / (1.0 + numpy.exp(-scores))) ** 1.2
+        probs /= probs.sum(axis=1)[:, numpy.newaxis]
+
+        return [None if u in failed else (1.0, self.index.to_dict(row))
+                for (u, row) in enumerate(probs)]
+
+
+def test_infer_batch():
+    features = [PriorFeature(), MilGovFeature(), TldFeature()]
+    intercept = -7.06
+    coefficients = [2.38, 2.87, 7.03]
+    inferrer = LogisticInferrer(features, intercept, coefficients)
+    urls = ['http://www.bbc.co.uk/news', 'whitehouse.gov', 'http://www.ibm.com/foo', 'lemonde.fr']
+    batch = inferrer.infer_batch(urls)
+    assert(len(batch) == len(urls))
+    for (url, (conf, dist)) in zip(urls, batch):
+        # reference implementation: one country at a time over feature dicts
+        expected = {}
+        for c in inferrer.countries:
+            expected[c.iso] = intercept
+        for (i, f) in enumerate(features):
+            (fconf, fdist) = f.infer(url)
+            for c in expected:
+                if fconf > 0 and fdist:
+                    expected[c] += coefficients[i] * fdist.get(c, 0.0)
+                else:
+                    expected[c] += coefficients[i] * 1.0 / len(expected)
+        for c in expected:
+            expected[c] = logistic(expected[c]) ** 1.2
+        total = sum(expected.values())
+        assert(conf == 1.0)
+        assert(set(dist.keys()) == set(expected.keys()))
+        for c in dist:
+            assert(abs(dist[c] - expected[c] / total) < 0.000001)
+
+
+class FailingFeature:
+    def __init__(self):
+        self.name = 'failing'
+        self.domain_only = True
+
+    def infer(self, url):
+        if 'fail' in get_url_info(url).host:
+            raise IOError('lookup failed')
+        return (0, {})
+
+def test_infer_batch_errors():
+    inferrer = LogisticInferrer([PriorFeature(), FailingFeature(), TldFeature()], -7.06, [2.38, 1.0, 7.03])
+    urls = ['http://www.bbc.co.uk/news', 'http://fail.example.com/', 'lemonde.fr']
+    batch = inferrer.infer_batch(urls)
+    assert(batch[1] is None)
+    assert(batch[0] == inferrer.infer(urls[0]) and batch[2] == inferrer.infer(urls[2]))
+    try:
+        inferrer.infer(urls[1])
+        assert(False)
+    except IOError:
+        pass
+
+
+def test_domain_cache():
+    inferrer = LogisticInferrer(
+        [PriorFeature(), MilGovFeature(), TldFeature()], -7.06, [2.38, 2.87, 7.03])
+    (conf, dist) = inferrer.infer('http://news.bbc.co.uk/a')
+    stats = inferrer.get_cache_stats()
+    assert((stats['hits'], stats['misses']) == (0, 1))
+    (conf2, dist2) = inferrer.infer('http://www.bbc.co.uk/b')
+    stats = inferrer.get_cache_stats()
+    assert((stats['hits'], stats['misses']) == (1, 1))
+    assert(dist == dist2)
+    inferrer.infer('http://www.bbc.com/b')
+    assert(inferrer.get_cache_stats()['misses'] == 2)
+
+
+class CountingFeature:
+    def __init__(self):
+        self.name = 'counting'
+        self.domain_only = False
+        self.cost = 4
+        self.calls = 0
+
+    def infer(self, url):
+        self.calls += 1
+        return (0.7, { 'fr' : 1.0 })
+
+def test_lazy():
+    expensive = CountingFeature()
+    features = [PriorFeature(), TldFeature(), expensive]
+    coefficients = [2.38, 7.03, 0.5]
+    lazy = LogisticInferrer(features, -7.06, coefficients, lazy=True)
+    full = LogisticInferrer(features, -7.06, coefficients)
+
+    (conf, dist) = lazy.infer('http://www.bbc.co.uk/news')
+    assert(expensive.calls == 0)
+    assert(lazy.get_cache_stats()['lazy_skips'] == 1)
+    # the domain features all ran, so the domain scores are cached
+    lazy.infer('http://news.bbc.co.uk/sport')
+    stats = lazy.get_cache_stats()
+    assert((stats['hits'], stats['misses'], stats['size']) == (1, 1, 1))
+    assert(expensive.calls == 0)
+    (conf2, dist2) = full.infer('http://www.bbc.co.uk/news')
+    assert(max(dist, key=dist.get) == max(dist2, key=dist2.get) == 'gb')
 
-        total = sum(result.values())
-        for (c, prob) in result.items():
-            result[c] = result[c] / total
+    lazy.infer('http://www.bbc.com/news')
+    assert(expensive.calls == 2)
+    assert(lazy.get_cache_stats()['size'] == 2)
 
-        return (1.0, result)
+    strict = LogisticInferrer(features, -7.06, coefficients, lazy=True, lazy_tolerance=0.0001)
+    strict.infer('http://www.bbc.co.uk/news')
+    assert(expensive.calls == 3)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,8 @@
 import codecs
+import collections
 import sys
+import threading
+import time
 import tldextract
 import urllib2
 
@@ -15,6 +18,9 @@ def get_feature_data_path(name):
 def get_data_path(filename):
     return DATA_DIR + '/' + filename
 
+def get_data_dir():
+    return DATA_DIR
+
 def set_data_dir(path):
     global DATA_DIR
     DATA_DIR = path
@@ -23,14 +29,21 @@ def set_feature_dir(path):
     global FEATURE_DIR
     FEATURE_DIR = path
 
+# How providers read their feature caches; see featurecache.open_feature_cache
+CACHE_BACKEND = 'dict'
+
+def get_cache_backend():
+    return CACHE_BACKEND
+
+def set_cache_backend(name):
+    global CACHE_BACKEND
+    CACHE_BACKEND = name
+
 def url2registereddomain(url):
-    host = url2host(url)
-    parts = tldextract.extract(host)
-    return parts.registered_domain
+    return get_url_info(url).registered_domain
 
 def url2tld(url):
-    host = url2host(url)
-    return host.split('.')[-1]
+    return get_url_info(url).tld
 
 def warn(message):
     sys.stderr.write(message + '\n')
@@ -60,9 +73,104 @@ def gp_open(path, mode='r', encoding='utf-8'):
     return enc_open(path, mode, encoding=encoding)
 
 def url2host(url):
-    if not url.startswith('http:') and not url.startswith('https:'):
-        url = 'http://' + url
-    return urllib2.urlparse.urlparse(url).netloc
+    return get_url_info(url).host
+
+
+class UrlInfo:
+    """
+    A url parsed once into the host, tld, and registered domain used by
+    the features. Create these with get_url_info(), which memoizes them.
+    """
+    def __init__(self, url):
+        self.url = url
+        if not url.startswith('http:') and not url.startswith('https:'):
+            url = 'http://' + url
+        self.host = urllib2.urlparse.urlparse(url).netloc
+        self.tld = self.host.split('.')[-1]
+        self.registered_domain = tldextract.extract(self.host).registered_domain
+
+    def __repr__(self):
+        return '{UrlInfo %s host=%s, tld=%s, domain=%s}' % (
+            self.url, self.host, self.tld, self.registered_domain)
+
+
+class LruCache:
+    """
+    A bounded, thread-safe mapping that evicts the least recently used key.
+    Counts of lookup hits and misses are kept for reporting.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class RateLimiter:
+    """
+    Spaces out requests to an external service so that requests for the
+    same key (e.g. a server name) start at least min_interval seconds apart.
+    Call wait() immediately before making a real network request, so that
+    answers served from local caches are never delayed. Keys whose next
+    start time has passed are pruned once more than max_keys are tracked.
+    """
+    def __init__(self, min_interval, max_keys=10000):
+        self.min_interval = min_interval
+        self.max_keys = max_keys
+        self.next_times = {}
+        self.lock = threading.Lock()
+
+    def wait(self, key=None):
+        with self.lock:
+            now = time.time()
+            if len(self.next_times) >= self.max_keys:
+                for (k, t) in self.next_times.items():
+                    if t <= now:
+                        del self.next_times[k]
+            start = max(now, self.next_times.get(key, 0.0))
+            self.next_times[key] = start + self.min_interval
+        if start > now:
+            time.sleep(start - now)
+
+
+URL_INFO_CACHE = LruCache(100000)
+
+def get_url_info(url):
+    """
+    Returns the UrlInfo for a url, parsing it only if it was not seen
+    recently. UrlInfo instances are passed through unchanged.
+    """
+    if isinstance(url, UrlInfo):
+        return url
+    info = URL_INFO_CACHE.get(url)
+    if info is None:
+        info = UrlInfo(url)
+        URL_INFO_CACHE.put(url, info)
+    return info
 
 
 def test_url2host():
@@ -75,4 +183,39 @@ def test_url2tld():
 
 def test_url2registereddomain():
     assert(url2registereddomain('http://www.ibm.com/foo/bar') == 'ibm.com')
-    assert(url2registereddomain('http://foo.bbc.co.uk/foo/bar') == 'bbc.co.uk')
\ No newline at end of file
+    assert(url2registereddomain('http://foo.bbc.co.uk/foo/bar') == 'bbc.co.uk')
+
+def test_url_info():
+    info = get_url_info('foo.bbc.co.uk/foo/bar')
+    assert(info.url == 'foo.bbc.co.uk/foo/bar')
+    assert((info.host, info.tld, info.registered_domain) == ('foo.bbc.co.uk', 'uk', 'bbc.co.uk'))
+    assert(get_url_info('foo.bbc.co.uk/foo/bar') is info)
+    assert(get_url_info(info) is info)
+    assert(url2host(info) == 'foo.bbc.co.uk')
+
+def test_lru_cache():
+    cache = LruCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert(cache.get('a') == 1)
+    cache.put('c', 3)
+    assert(cache.get('b') is None)
+    assert(cache.get('a') == 1 and cache.get('c') == 3)
+    assert(len(cache) == 2)
+    assert((cache.hits, cache.misses) == (3, 1))
+
+def test_rate_limiter():
+    limiter = RateLimiter(0.05)
+    start = time.time()
+    limiter.wait('a')
+    limiter.wait('b')
+    assert(time.time() - start < 0.05)
+    limiter.wait('a')
+    assert(time.time() - start >= 0.05)
+
+    limiter = RateLimiter(0.01, max_keys=10)
+    for i in range(100):
+        limiter.wait(i)
+    time.sleep(0.02)
+    limiter.wait('x')
+    assert(len(limiter.next_times) <= 10)
\ No newline at end of file
@@ -0,0 +1,220 @@
+"""
+Runs the network lookups behind the features concurrently, so that one
+process can keep hundreds of whois queries, page downloads and reverse
+geocodes in flight.
+
+Features that may touch the network name the external service they use
+in a "service" attribute. When a url is submitted, each of its features
+that is not already answered from a local cache is looked up in a thread
+pool. A lookup is only handed to the pool once its service is below its
+concurrency limit; until then it waits in a per-service queue, so a slow
+service never holds pool threads that other services could use. Once the
+lookups for a url are done, its feature caches are warm and the final
+inference is cheap.
+
+This codebase targets Python 2, which has no asyncio, so lookups are
+blocking calls that each hold a pool thread while in flight.
+"""
+
+import collections
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from gputils import *
+
+
+# default number of concurrent lookups per service
+SERVICE_LIMITS = {
+    'whois' : 50,
+    'download' : 100,
+    'geocode' : 1,
+    'geoip' : 4,
+}
+
+
+class LookupTask:
+    def __init__(self, key, f, url_info):
+        self.key = key
+        self.feature = f
+        self.url_info = url_info
+        self.done = threading.Event()
+
+    def ready(self):
+        return self.done.is_set()
+
+    def wait(self):
+        self.done.wait()
+
+
+class PendingInference:
+    """
+    The result of LookupEngine.submit(). get() waits for the url's lookups
+    and then combines the warmed features into a (conf, dist) pair.
+    """
+    def __init__(self, inferrer, url_info, lookups):
+        self.inferrer = inferrer
+        self.url_info = url_info
+        self.lookups = lookups
+
+    def ready(self):
+        return all(l.ready() for l in self.lookups)
+
+    def get(self):
+        for l in self.lookups:
+            l.wait()
+        return self.inferrer.infer(self.url_info)
+
+
+class LookupEngine:
+    def __init__(self, inferrer, max_in_flight=200, limits=None):
+        if limits is None: limits = SERVICE_LIMITS
+        self.inferrer = inferrer
+        self.pool = ThreadPool(max_in_flight)
+        self.limits = dict(limits)
+        self.active = collections.defaultdict(int)
+        self.queued = collections.defaultdict(collections.deque)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def lookup_key(self, f, url_info):
+        if getattr(f, 'domain_only', False):
+            return (f.service, url_info.registered_domain or url_info.host)
+        else:
+            return (f.service, url_info.url)
+
+    def start(self, task):
+        """
+        Hands a task to the pool, or queues it if its service is at its
+        limit. Must be called with the lock held.
+        """
+        service = task.feature.service
+        limit = self.limits.get(service)
+        if limit is not None and self.active[service] >= limit:
+            self.queued[service].append(task)
+        else:
+            self.active[service] += 1
+            self.pool.apply_async(self.lookup, (task,))
+
+    def lookup(self, task):
+        (f, url_info) = (task.feature, task.url_info)
+        try:
+            f.infer(url_info)
+        except:
+            # the lookup is retried, and reported, by the final inference
+            warn('lookup of %s for %s failed: %s' % (f.name, url_info.url, sys.exc_info()[1]))
+        finally:
+            with self.lock:
+                del self.in_flight[task.key]
+                self.active[f.service] -= 1
+                if self.queued[f.service]:
+                    self.start(self.queued[f.service].popleft())
+            task.done.set()
+
+    def submit(self, url):
+        """
+        Starts the lookups needed for a url and returns a PendingInference.
+        Lookups already in flight for the same domain or url are shared.
+        """
+        url_info = get_url_info(url)
+        lookups = []
+        for f in self.inferrer.features:
+            if not getattr(f, 'service', None):
+                continue
+            if hasattr(f, 'is_cached') and f.is_cached(url_info):
+                continue
+            key = self.lookup_key(f, url_info)
+            with self.lock:
+                if key not in self.in_flight:
+                    self.in_flight[key] = LookupTask(key, f, url_info)
+                    self.start(self.in_flight[key])
+                lookups.append(self.in_flight[key])
+        return PendingInference(self.inferrer, url_info, lookups)
+
+    def infer_all(self, urls, window=1000):
+        """
+        Generates (conf, dist) pairs for urls in order, keeping up to
+        window urls submitted ahead of the one being returned.
+        """
+        pending = collections.deque()
+        for url in urls:
+            pending.append(self.submit(url))
+            if len(pending) > window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class SlowFeature:
+    def __init__(self, service='slow', delay=0.05, suffix=None):
+        self.name = service
+        self.domain_only = True
+        self.service = service
+        self.delay = delay
+        self.suffix = suffix    # if set, only domains ending with it need a lookup
+        self.finished = 0.0
+        self.cache = {}
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def is_cached(self, url):
+        domain = get_url_info(url).registered_domain
+        return domain in self.cache or bool(self.suffix and not domain.endswith(self.suffix))
+
+    def infer(self, url):
+        domain = get_url_info(url).registered_domain
+        if self.suffix and not domain.endswith(self.suffix):
+            return (0, {})
+        if domain not in self.cache:
+            with self.lock:
+                self.calls += 1
+                self.active += 1
+                self.max_active = max(self.active, self.max_active)
+            time.sleep(self.delay)
+            with self.lock:
+                self.active -= 1
+                self.finished = time.time()
+            self.cache[domain] = 'fr' if domain.endswith('.fr') else 'us'
+        return (0.9, { self.cache[domain] : 1.0 })
+
+def test_lookup_engine():
+    from gpinfer import LogisticInferrer, PriorFeature
+
+    slow = SlowFeature()
+    inferrer = LogisticInferrer([PriorFeature(), slow], -7.06, [2.38, 5.0])
+    engine = LookupEngine(inferrer, max_in_flight=10, limits={'slow' : 2})
+    urls = ['http://a%d.fr/x' % i for i in range(4)] + ['http://a0.fr/y', 'http://b.com/']
+    results = list(engine.infer_all(urls, window=3))
+    engine.close()
+
+    assert(slow.calls == 5)
+    assert(slow.max_active <= 2)
+    assert(len(results) == len(urls))
+    for (url, (conf, dist)) in zip(urls, results):
+        assert(max(dist, key=dist.get) == ('fr' if '.fr' in url else 'us'))
+
+def test_service_limits():
+    from gpinfer import LogisticInferrer, PriorFeature
+
+    # queued geocodes must not hold pool threads that whois lookups could use
+    geocode = SlowFeature('geocode', 0.3, '.fr')
+    whois = SlowFeature('whois', 0.02, '.com')
+    inferrer = LogisticInferrer([PriorFeature(), geocode, whois], -7.06, [2.38, 5.0, 5.0])
+    engine = LookupEngine(inferrer, max_in_flight=4, limits={'geocode' : 1, 'whois' : 50})
+    start = time.time()
+    urls = ['http://g%d.fr/' % i for i in range(4)] + ['http://w%d.com/' % i for i in range(30)]
+    pending = [engine.submit(url) for url in urls]
+    for p in pending:
+        p.get()
+    engine.close()
+
+    assert(geocode.calls == 4 and geocode.max_active == 1 and whois.calls == 30)
+    assert(geocode.finished - start >= 1.2)
+    assert(whois.finished - start < 0.6)
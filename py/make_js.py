@@ -1,12 +1,12 @@
 import json
 
 from gputils import *
-from whois import read_aliases
+from whois import get_alias_index
 from country import read_countries
 from pagelang import CountrylangProvider
 
 domain_coords = json.load(open(get_data_path('wikidata.json')))
-aliases = read_aliases()
+alias_index = get_alias_index()
 countries = read_countries()
 
 def write_json(var_name, data, path):
@@ -26,11 +26,7 @@ for c in countries:
     })
 write_json('GP_COUNTRIES', country_json, '../js/country_data.js')
 
-alias_json = {}
-for iso in aliases:
-    for a in aliases[iso]:
-        alias_json[a] = iso
-write_json('GP_ALIASES', alias_json, '../js/alias_data.js')
+write_json('GP_ALIASES', alias_index.exact, '../js/alias_data.js')
 
 coord_json = {}
 for (host, coords) in domain_coords.items():
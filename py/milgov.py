@@ -1,18 +1,30 @@
 from gputils import *
 
-from country import read_countries
+from country import read_countries, get_country_index
 
 class MilGovFeature:
     def __init__(self):
         self.name = 'mil'
+        self.domain_only = True
+        self.cost = 0
+        self.us = get_country_index().point('us')
 
-    def infer(self, url):
+    def is_milgov(self, url):
         host = url2host(url)
-        if host.endswith('.mil') or host.endswith('.gov'):
+        return host.endswith('.mil') or host.endswith('.gov')
+
+    def infer(self, url):
+        if self.is_milgov(url):
             return (1.0, { 'us' : 1.0 })
         else:
             return (0, {})
 
+    def infer_array(self, url):
+        if self.is_milgov(url):
+            return (1.0, self.us)
+        else:
+            return (0, None)
+
 def test_milgov():
     f = MilGovFeature()
     assert(f.infer_dist('http://foo.bbc.com/bar') == (0, {}))
@@ -19,11 +19,16 @@ import langid
 import sys
 
 from gputils import *
+from featurecache import open_feature_cache
 
 from downloader import url_to_text
 
 import country
 
+# langid only needs the start of a page to be confident of its language
+PAGE_BYTES_BUDGET = 256*1024
+PAGE_CHARS_BUDGET = 10000
+
 
 class PagelangProvider:
     """
@@ -35,42 +40,26 @@ class PagelangProvider:
         if not os.path.isfile(cache_path):
             raise GPException('page language results not available...')
         self.cache_path = cache_path
+        decode = lambda lang: None if lang in ('unknown', '') else lang
+        self.pagelangs = open_feature_cache(self.cache_path, decode, 'pagelang')
 
-        warn('reading pagelang results...')
-        nlines = 0
-        self.pagelangs = {}
-        for line in gp_open(self.cache_path):
-            tokens = line.strip().split('\t')
-            if len(tokens) == 2:
-                url = tokens[0]
-                cc = tokens[1]
-                if cc == 'unknown':
-                    cc = None
-                self.pagelangs[url] = cc
-                nlines += 1
-            else:
-                warn('invalid pagelang line: %s' % `line`)
-        warn('finished reading %d pagelang entries' % nlines)
+    def is_cached(self, url):
+        return get_url_info(url).url in self.pagelangs
 
     def get(self, url):
+        url = get_url_info(url).url
         if url not in self.pagelangs:
             lang = None
             try:
-                text = url_to_text(url)
+                text = url_to_text(url, PAGE_BYTES_BUDGET, PAGE_CHARS_BUDGET)
                 if text:
                     (l, confidence) = langid.classify(text)
                     if confidence >= 0.9:
                         lang = l
             except:
                 warn('language detection scraping for %s failed: %s' % (url, sys.exc_info()[1]))
-            self.pagelangs[url] = lang
-            self.add_cache_line(url + u'\t' + (lang if lang else 'unknown'))
-        return self.pagelangs[url]
-
-    def add_cache_line(self, line):
-        f = gp_open(self.cache_path, 'a')
-        f.write(line + u'\n')
-        f.close()
+            self.pagelangs.put(url, lang if lang else u'unknown')
+        return self.pagelangs.get(url)
 
 
 class CountrylangProvider:
@@ -112,6 +101,11 @@ class PagelangsFeature:
         self.country_provider = country_provider
 
         self.name = 'pagelang'
+        self.domain_only = False
+        self.cost = 4
+        self.service = 'download'
+        self.index = country.get_country_index()
+        self.lang_values = {}
 
     def infer(self, url):
         lang = self.page_provider.get(url)
@@ -124,6 +118,25 @@ class PagelangsFeature:
 
         return (0.70, candidates)
 
+    def infer_array(self, url):
+        lang = self.page_provider.get(url)
+        if not lang:
+            return (0, None)
+
+        if lang not in self.lang_values:
+            candidates = self.country_provider.get(lang)
+            if candidates:
+                self.lang_values[lang] = self.index.sparse(dict(candidates))
+            else:
+                self.lang_values[lang] = None
+        if self.lang_values[lang] is None:
+            return (0, None)
+
+        return (0.70, self.lang_values[lang])
+
+    def is_cached(self, url):
+        return self.page_provider.is_cached(url)
+
 
 def test_offline_pagelang_provider():
     provider = PagelangProvider()
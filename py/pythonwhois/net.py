@@ -1,60 +1,100 @@
-import socket, re, sys
+import socket, re, sys, os, csv, time, pkgutil, threading
 from codecs import encode, decode
 from . import shared
 
+# If set, called with the server name before each request is sent.
+# Used by callers to rate limit queries to individual WHOIS servers.
+rate_limiter = None
+
+# Root WHOIS servers by TLD, so that IANA is only asked about each TLD once. The table is seeded from
+# root_servers.dat. Referrals learned from IANA are appended to root_server_cache_path, if it is set,
+# and asked for again once they are older than root_server_ttl seconds. TLDs that IANA has no WHOIS
+# server for are remembered too, as "-", for root_server_negative_ttl seconds.
+root_server_cache_path = None
+root_server_ttl = 30 * 24 * 3600
+root_server_negative_ttl = 24 * 3600
+root_servers = None # tld -> (server or None, time learned, or None for bundled entries)
+root_servers_lock = threading.Lock()
+
+# Deadlines for each WHOIS request in seconds: to connect, between received chunks, and overall.
+# Responses are cut off after max_response_size bytes.
+connect_timeout = 10
+read_timeout = 10
+total_timeout = 30
+max_response_size = 1024 * 1024
+
+# Sometimes IANA simply won't give us the right root WHOIS server
+exceptions = {
+	".ac.uk": "whois.ja.net",
+	".ps": "whois.pnina.ps",
+	".buzz": "whois.nic.buzz",
+	".moe": "whois.nic.moe",
+	".arpa": "whois.iana.org",
+	".bid": "whois.nic.bid",
+	".int": "whois.iana.org",
+	".kred": "whois.nic.kred",
+	".nagoya": "whois.gmoregistry.net",
+	".nyc": "whois.nic.nyc",
+	".okinawa": "whois.gmoregistry.net",
+	".qpon": "whois.nic.qpon",
+	".sohu": "whois.gtld.knet.cn",
+	".tokyo": "whois.nic.tokyo",
+	".trade": "whois.nic.trade",
+	".webcam": "whois.nic.webcam",
+	".xn--rhqv96g": "whois.nic.xn--rhqv96g",
+	# The following is a bit hacky, but IANA won't return the right answer for example.com because it's a direct registration.
+	"example.com": "whois.verisign-grs.com"
+}
+
 def get_whois_raw(domain, server="", previous=None, rfc3490=True, never_cut=False, with_server_list=False, server_list=None):
 	previous = previous or []
 	server_list = server_list or []
-	# Sometimes IANA simply won't give us the right root WHOIS server
-	exceptions = {
-		".ac.uk": "whois.ja.net",
-		".ps": "whois.pnina.ps",
-		".buzz": "whois.nic.buzz",
-		".moe": "whois.nic.moe",
-		".arpa": "whois.iana.org",
-		".bid": "whois.nic.bid",
-		".int": "whois.iana.org",
-		".kred": "whois.nic.kred",
-		".nagoya": "whois.gmoregistry.net",
-		".nyc": "whois.nic.nyc",
-		".okinawa": "whois.gmoregistry.net",
-		".qpon": "whois.nic.qpon",
-		".sohu": "whois.gtld.knet.cn",
-		".tokyo": "whois.nic.tokyo",
-		".trade": "whois.nic.trade",
-		".webcam": "whois.nic.webcam",
-		".xn--rhqv96g": "whois.nic.xn--rhqv96g",
-		# The following is a bit hacky, but IANA won't return the right answer for example.com because it's a direct registration.
-		"example.com": "whois.verisign-grs.com"
-	}
 
 	if rfc3490:
-		if sys.version_info < (3, 0):
-			domain = encode( domain if type(domain) is unicode else decode(domain, "utf8"), "idna" )
-		else:
-			domain = encode(domain, "idna").decode("ascii")
+		domain = encode_domain(domain)
 
 	if len(previous) == 0 and server == "":
 		# Root query
-		is_exception = False
-		for exception, exc_serv in exceptions.items():
-			if domain.endswith(exception):
-				is_exception = True
-				target_server = exc_serv
-				break
-		if is_exception == False:
-			target_server = get_root_server(domain)
+		target_server = get_first_server(domain)
 	else:
 		target_server = server
+	response = whois_request(get_request_domain(domain, target_server), target_server)
+	new_list, referal_server = process_response(domain, server, target_server, response, previous, never_cut)
+	server_list.append(target_server)
+	if referal_server is not None:
+		# Referal to another WHOIS server...
+		return get_whois_raw(domain, referal_server, new_list, server_list=server_list, with_server_list=with_server_list)
+	if with_server_list:
+		return (new_list, server_list)
+	else:
+		return new_list
+
+# The steps of get_whois_raw, for callers that schedule the requests themselves.
+
+def encode_domain(domain):
+	if sys.version_info < (3, 0):
+		return encode( domain if type(domain) is unicode else decode(domain, "utf8"), "idna" )
+	else:
+		return encode(domain, "idna").decode("ascii")
+
+def get_first_server(domain):
+	for exception, exc_serv in exceptions.items():
+		if domain.endswith(exception):
+			return exc_serv
+	return get_root_server(domain)
+
+def get_request_domain(domain, target_server):
 	if target_server == "whois.jprs.jp":
-		request_domain = "%s/e" % domain # Suppress Japanese output
+		return "%s/e" % domain # Suppress Japanese output
 	elif domain.endswith(".de") and ( target_server == "whois.denic.de" or target_server == "de.whois-servers.net" ):
-		request_domain = "-T dn,ace %s" % domain # regional specific stuff
+		return "-T dn,ace %s" % domain # regional specific stuff
 	elif target_server == "whois.verisign-grs.com":
-		request_domain = "=%s" % domain # Avoid partial matches
+		return "=%s" % domain # Avoid partial matches
 	else:
-		request_domain = domain
-	response = whois_request(request_domain, target_server)
+		return domain
+
+def process_response(domain, server, target_server, response, previous, never_cut=False):
+	"""Returns the records so far, and the server the response refers to (or None)."""
 	if never_cut:
 		# If the caller has requested to 'never cut' responses, he will get the original response from the server (this is
 		# useful for callers that are only interested in the raw data). Otherwise, if the target is verisign-grs, we will
@@ -72,20 +112,91 @@ def get_whois_raw(domain, server="", previous=None, rfc3490=True, never_cut=Fals
 				break
 	if never_cut == False:
 		new_list = [response] + previous
-	server_list.append(target_server)
 	for line in [x.strip() for x in response.splitlines()]:
 		match = re.match("(refer|whois server|referral url|whois server|registrar whois):\s*([^\s]+\.[^\s]+)", line, re.IGNORECASE)
 		if match is not None:
 			referal_server = match.group(2)
 			if referal_server != server and "://" not in referal_server: # We want to ignore anything non-WHOIS (eg. HTTP) for now.
-				# Referal to another WHOIS server...
-				return get_whois_raw(domain, referal_server, new_list, server_list=server_list, with_server_list=with_server_list)
-	if with_server_list:
-		return (new_list, server_list)
-	else:
-		return new_list
+				return new_list, referal_server
+	return new_list, None
+
+def set_root_server_cache(path):
+	global root_server_cache_path, root_servers
+	with root_servers_lock:
+		root_server_cache_path = path
+		root_servers = None
+
+def load_root_servers():
+	servers = {}
+	try:
+		data = pkgutil.get_data("pythonwhois", "root_servers.dat")
+		if sys.version_info >= (3, 0):
+			data = data.decode("utf-8")
+		for line in csv.DictReader(data.splitlines()):
+			servers[line["tld"]] = (line["server"], None)
+	except IOError as e:
+		pass
+	if root_server_cache_path is not None and os.path.isfile(root_server_cache_path):
+		with open(root_server_cache_path) as f:
+			for line in f:
+				tokens = line.split()
+				if len(tokens) == 3:
+					servers[tokens[0]] = (None if tokens[1] == "-" else tokens[1], float(tokens[2]))
+	return servers
+
+def remember_root_server(tld, server):
+	learned = time.time()
+	with root_servers_lock:
+		root_servers[tld] = (server, learned)
+		if root_server_cache_path is not None:
+			with open(root_server_cache_path, "a") as f:
+				f.write("%s\t%s\t%d\n" % (tld, server or "-", learned))
 
 def get_root_server(domain):
+	global root_servers
+	tld = domain.rstrip(".").split(".")[-1].lower()
+	with root_servers_lock:
+		if root_servers is None:
+			root_servers = load_root_servers()
+		entry = root_servers.get(tld)
+	if entry is not None and entry[0] is None and time.time() - entry[1] < root_server_negative_ttl:
+		raise shared.WhoisException("No root WHOIS server found for domain.")
+	if entry is not None and entry[0] is not None and (entry[1] is None or time.time() - entry[1] < root_server_ttl):
+		return entry[0]
+	try:
+		server = query_root_server(domain)
+	except (shared.WhoisTimeout, socket.error) as e:
+		if entry is not None and entry[0] is not None:
+			return entry[0] # A stale referral beats none at all
+		raise
+	except shared.WhoisException as e:
+		if entry is not None and entry[0] is not None:
+			return entry[0]
+		remember_root_server(tld, None) # IANA answered, but without a referral
+		raise
+	remember_root_server(tld, server)
+	return server
+
+def refresh_root_servers(tlds=None):
+	"""Asks IANA again for the root server of each TLD (by default, every known one), and rewrites the cache file."""
+	global root_servers
+	with root_servers_lock:
+		if root_servers is None:
+			root_servers = load_root_servers()
+		tlds = tlds or list(root_servers.keys())
+	for tld in tlds:
+		try:
+			remember_root_server(tld, query_root_server(tld))
+		except (shared.WhoisException, socket.error) as e:
+			pass # Keep the old entry
+	with root_servers_lock:
+		if root_server_cache_path is not None:
+			with open(root_server_cache_path, "w") as f:
+				for tld, (server, learned) in sorted(root_servers.items()):
+					if learned is not None:
+						f.write("%s\t%s\t%d\n" % (tld, server or "-", learned))
+
+def query_root_server(domain):
 	data = whois_request(domain, "whois.iana.org")
 	for line in [x.strip() for x in data.splitlines()]:
 		match = re.match("refer:\s*([^\s]+)", line)
@@ -95,13 +206,32 @@ def get_root_server(domain):
 	raise shared.WhoisException("No root WHOIS server found for domain.")
 
 def whois_request(domain, server, port=43):
-	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	sock.connect((server, port))
-	sock.send(("%s\r\n" % domain).encode("utf-8"))
-	buff = b""
-	while True:
-		data = sock.recv(1024)
-		if len(data) == 0:
-			break
-		buff += data
-	return buff.decode("utf-8", "replace")
+	if rate_limiter is not None:
+		rate_limiter(server)
+	return send_request(domain, server, port)
+
+def send_request(domain, server, port=43):
+	"""Like whois_request, but without waiting for the rate limiter."""
+	deadline = time.time() + total_timeout
+	try:
+		sock = socket.create_connection((server, port), min(connect_timeout, total_timeout))
+	except socket.timeout as e:
+		raise shared.WhoisTimeout("Connecting to %s timed out." % server)
+	try:
+		sock.sendall(("%s\r\n" % domain).encode("utf-8"))
+		buff = bytearray()
+		while len(buff) < max_response_size:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				raise shared.WhoisTimeout("%s did not finish responding in %s seconds." % (server, total_timeout))
+			sock.settimeout(min(read_timeout, remaining))
+			try:
+				data = sock.recv(65536)
+			except socket.timeout as e:
+				raise shared.WhoisTimeout("Reading from %s timed out." % server)
+			if len(data) == 0:
+				break
+			buff.extend(data)
+	finally:
+		sock.close()
+	return bytes(buff[:max_response_size]).decode("utf-8", "replace")
@@ -419,6 +419,85 @@ nic_contact_references["tech"] = precompile_regexes(nic_contact_references["tech
 nic_contact_references["admin"] = precompile_regexes(nic_contact_references["admin"])
 nic_contact_references["billing"] = precompile_regexes(nic_contact_references["billing"])
 
+def uncapture(pattern):
+	"""Turns the capturing groups of a regex pattern into non-capturing ones."""
+	result = []
+	i = 0
+	in_class = False
+	while i < len(pattern):
+		c = pattern[i]
+		if c == "\\":
+			result.append(pattern[i:i + 2])
+			i += 2
+			continue
+		if in_class:
+			in_class = (c != "]")
+		elif c == "[":
+			# a "]" right after "[" or "[^" is a literal
+			j = i + 1
+			if pattern[j:j + 1] == "^":
+				j += 1
+			if pattern[j:j + 1] == "]":
+				j += 1
+			result.append(pattern[i:j])
+			i = j
+			in_class = True
+			continue
+		elif c == "(":
+			if pattern.startswith("(?P<", i):
+				c = "(?:"
+				i = pattern.index(">", i)
+			elif not pattern.startswith("(?", i):
+				c = "(?:"
+		result.append(c)
+		i += 1
+	return "".join(result)
+
+def combine_regexes(regexes):
+	"""Combines compiled regexes into one that matches wherever any of them does, or returns None if they can't be combined."""
+	if not regexes or len(set(regex.flags for regex in regexes)) != 1:
+		return None
+	patterns = [regex.pattern for regex in regexes]
+	if any("(?P=" in pattern or re.search(r"\\[1-9]", pattern) for pattern in patterns):
+		return None
+	try:
+		return re.compile("|".join("(?:%s)" % uncapture(pattern) for pattern in patterns), regexes[0].flags)
+	except (re.error, AssertionError, OverflowError):
+		return None
+
+class GrammarEngine:
+	"""Applies the grammar['_data'] rules to each line of a segment in a single pass.
+
+	Each rule key gets one combined prefilter regex, and lines that match no rule at
+	all are skipped, so the individual regexes only run on lines that they may match.
+	Values are collected in the same order as trying each key's regexes on every line."""
+	def __init__(self, rules):
+		self.rules = [(key, regexes, combine_regexes(regexes)) for key, regexes in rules.items()]
+		self.any_rule = combine_regexes([regex for key, regexes in rules.items() for regex in regexes])
+
+	def parse_segment(self, segment, data):
+		active = [rule for rule in self.rules if rule[0] not in data]
+		if not active:
+			return
+		for line in segment.splitlines():
+			if self.any_rule is not None and self.any_rule.search(line) is None:
+				continue
+			for rule_key, rule_regexes, prefilter in active:
+				if prefilter is not None and prefilter.search(line) is None:
+					continue
+				for regex in rule_regexes:
+					result = regex.search(line)
+
+					if result is not None:
+						val = result.group("val").strip()
+						if val != "":
+							try:
+								data[rule_key].append(val)
+							except KeyError as e:
+								data[rule_key] = [val]
+
+grammar_engine = GrammarEngine(grammar["_data"])
+
 if sys.version_info < (3, 0):
 	def is_string(data):
 		"""Test for string with support for python 2."""
@@ -436,19 +515,7 @@ def parse_raw_whois(raw_data, normalized=None, never_query_handles=True, handle_
 	raw_data = [segment.replace("\r", "") for segment in raw_data] # Carriage returns are the devil
 
 	for segment in raw_data:
-		for rule_key, rule_regexes in grammar['_data'].items():
-			if (rule_key in data) == False:
-				for line in segment.splitlines():
-					for regex in rule_regexes:
-						result = re.search(regex, line)
-
-						if result is not None:
-							val = result.group("val").strip()
-							if val != "":
-								try:
-									data[rule_key].append(val)
-								except KeyError as e:
-									data[rule_key] = [val]
+		grammar_engine.parse_segment(segment, data)
 
 		# Whois.com is a bit special... Fabulous.com also seems to use this format. As do some others.
 		match = re.search("^\s?Name\s?[Ss]ervers:?\s*\n((?:\s*.+\n)+?\s?)(?:\n|$)", segment, re.MULTILINE)
@@ -981,6 +1048,37 @@ def parse_registrants(data, never_query_handles=True, handle_server=""):
 		"billing": billing_contact,
 	}
 
+contact_regexes = {
+	"registrant": registrant_regexes,
+	"tech": tech_contact_regexes,
+	"admin": admin_contact_regexes,
+	"billing": billing_contact_regexes,
+}
+
+def parse_contact_country(data, category):
+	"""Returns the country of one contact as parse_registrants would report it, without parsing anything else.
+
+	Returns None if the contact has no country, and False if only parse_registrants can tell: when the
+	contact may be given by a NIC handle reference, or its country may need the ROC/Taiwan correction."""
+	for regex in nic_contact_references[category]:
+		for segment in data:
+			if re.search(regex, segment) is not None:
+				return False
+
+	# parse_registrants keeps the match from the last segment that has one
+	for segment in reversed(data):
+		for regex in contact_regexes[category]:
+			match = re.search(regex, segment)
+			if match is not None:
+				country = match.groupdict().get("country")
+				if country is None or country.strip() == "":
+					return None
+				country = country.strip()
+				if re.match("^R\.?O\.?C\.?$", country, re.IGNORECASE) or country.lower() == "republic of china":
+					return False
+				return country
+	return None
+
 def fetch_nic_contact(handle, lookup_server):
 	response = net.get_whois_raw(handle, lookup_server)
 	response = [segment.replace("\r", "") for segment in response] # Carriage returns are the devil
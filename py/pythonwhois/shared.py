@@ -1,2 +1,6 @@
 class WhoisException(Exception):
 	pass
+
+class WhoisTimeout(WhoisException):
+	"""Raised when a WHOIS server doesn't connect or finish responding in time."""
+	pass
@@ -5,52 +5,142 @@
 #
 
 
+import argparse
+import collections
 import sys
-import time
 import traceback
 
+from multiprocessing.pool import ThreadPool
+
 from gputils import *
 from gpinfer import LogisticInferrer
+from lookup import LookupEngine
+from featurecache import commit_cache_writers
+from whois import set_archive_raw_whois
+from downloader import set_text_extractor
 
 
-def main(inferrer, input, output):
+def format_result(url, dist):
     format = lambda x: '%.4f' % x
+    if dist:
+        items = list(dist.items())
+        items.sort(key=lambda x: x[1], reverse=True)
+        (maxcountry, maxp) = items[0]
+        json = '{'
+        for (i, (c, p)) in enumerate(items[:10]):
+            if i != 0:
+                json += ', '
+            json += "'%s' : %s" % (c, format(p))
+        json += '}'
+        return url + '\t' + maxcountry + '\t' + format(maxp) + '\t' + json + '\n'
+    else:
+        return url + '\tunknown\t0.0\t{}\n'
+
+
+def capture_result(url, infer):
+    """
+    Calls infer() and returns a (line, error) pair, where exactly one is set.
+    Errors are returned rather than raised so they can be reported in order.
+    """
+    try:
+        (conf, dist) = infer()
+        return (format_result(url, dist), None)
+    except:
+        return (None, traceback.format_exc())
+
+
+def infer_url(inferrer, url):
+    return capture_result(url, lambda: inferrer.infer(url))
+
+
+def write_result(output, url, result):
+    (line, error) = result
+    if error:
+        warn('url %s failed: ' % url)
+        sys.stderr.write(error)
+    else:
+        output.write(line)
+        output.flush()
+
+
+def read_urls(input):
     for line in input:
-        url = line.split()[0]
-        if not url:
-            continue
+        tokens = line.split()
+        if tokens:
+            yield tokens[0]
+
+
+def main(inferrer, input, output, workers=1, lookups=0):
+    if lookups > 0:
+        # The lookup engine keeps many network lookups in flight, and
+        # combines each url's warmed features in order.
+        engine = LookupEngine(inferrer, max_in_flight=lookups)
+        pending = collections.deque()
         try:
-            (conf, dist) = inferrer.infer(url)
-            if dist:
-                items = list(dist.items())
-                items.sort(key=lambda x: x[1], reverse=True)
-                (maxcountry, maxp) = items[0]
-                json = '{'
-                for (i, (c, p)) in enumerate(items[:10]):
-                    if i != 0:
-                        json += ', '
-                    json += "'%s' : %s" % (c, format(p))
-                json += '}'
-                output.write(url + '\t' + maxcountry + '\t' + format(maxp) + '\t' + json + '\n')
-                output.flush()
-            else:
-                output.write(url + '\tunknown\t0.0\t{}\n')
-                output.flush()
-        except:
-            warn('url %s failed: ' % url)
-            traceback.print_exc()
-        time.sleep(10)
+            for url in read_urls(input):
+                pending.append((url, engine.submit(url)))
+                while len(pending) > lookups * 4:
+                    (url, result) = pending.popleft()
+                    write_result(output, url, capture_result(url, result.get))
+            while pending:
+                (url, result) = pending.popleft()
+                write_result(output, url, capture_result(url, result.get))
+        finally:
+            engine.close()
+        return
+
+    if workers <= 1:
+        for url in read_urls(input):
+            write_result(output, url, infer_url(inferrer, url))
+        return
+
+    # Urls are handed to a pool of threads, since most of the time is spent
+    # waiting on network lookups. A bounded window of pending results keeps
+    # output in input order without reading all of stdin up front.
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    try:
+        for url in read_urls(input):
+            pending.append((url, pool.apply_async(infer_url, (inferrer, url))))
+            while len(pending) > workers * 4:
+                (url, result) = pending.popleft()
+                write_result(output, url, result.get())
+        while pending:
+            (url, result) = pending.popleft()
+            write_result(output, url, result.get())
+    finally:
+        pool.close()
+        pool.join()
+
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        set_feature_dir(sys.argv[1])
-    elif len(sys.argv) == 3:
-        set_feature_dir(sys.argv[1])
-        set_data_dir(sys.argv[2])
-    elif len(sys.argv) != 1:
-        warn('usage: %s [feature_dir [data_dir]]')
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description='Infers the geoprovenance of urls read from stdin.')
+    parser.add_argument('feature_dir', nargs='?', help='directory containing the feature caches')
+    parser.add_argument('data_dir', nargs='?', help='directory containing the data files')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of urls to process concurrently in a thread pool (default 1)')
+    parser.add_argument('--lookups', type=int, default=0,
+                        help='use the lookup engine with this many network lookups in flight')
+    parser.add_argument('--cache-backend', choices=['dict', 'sqlite'], default='dict',
+                        help='keep feature caches in memory (dict) or query an on-disk index (sqlite)')
+    parser.add_argument('--archive-whois', action='store_true',
+                        help='keep raw whois records for reparsing with whoisarchive.py')
+    parser.add_argument('--text-extractor', choices=['soup', 'stream'], default='soup',
+                        help='extract page text with BeautifulSoup or a faster streaming parser')
+    args = parser.parse_args()
+
+    if args.feature_dir:
+        set_feature_dir(args.feature_dir)
+    if args.data_dir:
+        set_data_dir(args.data_dir)
+    set_cache_backend(args.cache_backend)
+    set_archive_raw_whois(args.archive_whois)
+    set_text_extractor(args.text_extractor)
 
     inferrer = LogisticInferrer()
 
-    main(inferrer, sys.stdin, sys.stdout)
\ No newline at end of file
+    main(inferrer, sys.stdin, sys.stdout, args.workers, args.lookups)
+    commit_cache_writers()
+
+    stats = inferrer.get_cache_stats()
+    warn('domain cache: %d hits, %d misses' % (stats['hits'], stats['misses']))
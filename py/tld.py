@@ -1,12 +1,16 @@
 from gputils import *
 
-from country import read_countries
+from country import read_countries, get_country_index
 
 class TldFeature:
     def __init__(self, countries=None):
         if not countries: countries = read_countries()
         self.name = 'tld'
+        self.domain_only = True
+        self.cost = 0
         self.tld_countries = dict([(c.tld, c) for c in countries])
+        index = get_country_index()
+        self.tld_values = dict([(c.tld, index.point(c.iso)) for c in countries])
 
     def infer(self, url):
         tld = url2tld(url)
@@ -16,8 +20,23 @@ class TldFeature:
         else:
             return (0, {})
 
+    def infer_array(self, url):
+        tld = url2tld(url)
+        if tld not in GENERIC_TLDS and tld in self.tld_values:
+            return (0.95, self.tld_values[tld])
+        else:
+            return (0, None)
+
 def test_tld():
     f = TldFeature()
     assert(f.infer('http://bbc.com/foo/bar') == (0, {}))
     assert(f.infer('http://bbc.co.uk/foo') == (0.95, { 'gb' : 1.0}))
     assert(f.infer('bbc.co.uk') == (0.95, { 'gb' : 1.0}))
+
+def test_tld_array():
+    f = TldFeature()
+    index = get_country_index()
+    assert(f.infer_array('http://bbc.com/foo/bar') == (0, None))
+    (conf, (indexes, probs)) = f.infer_array('http://bbc.co.uk/foo')
+    assert(conf == 0.95)
+    assert(list(indexes) == [index.index('gb')] and list(probs) == [1.0])
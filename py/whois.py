@@ -18,14 +18,34 @@ only used as a last resort.
 """
 
 import collections
+import cPickle
+import hashlib
 import os
 import re
+import socket
+import tempfile
 
 import pythonwhois
 
 from gputils import *
+from featurecache import open_feature_cache, RecordArchive, SKIP
 
-from country import read_countries
+from country import read_countries, get_country_index
+
+# Whether WhoisProvider keeps the raw records it retrieves; see whoisarchive.py
+ARCHIVE_RAW_WHOIS = False
+
+def set_archive_raw_whois(enabled):
+    global ARCHIVE_RAW_WHOIS
+    ARCHIVE_RAW_WHOIS = enabled
+
+def get_whois_archive_path(cache_path=None):
+    if not cache_path: cache_path = get_feature_data_path('whois')
+    return os.path.join(os.path.dirname(cache_path), 'whois_raw.dat')
+
+# at most one query per second to each whois server
+WHOIS_LIMITER = RateLimiter(1.0)
+pythonwhois.net.rate_limiter = WHOIS_LIMITER.wait
 
 class WhoisProvider:
     """
@@ -39,52 +59,49 @@ class WhoisProvider:
         if not os.path.isfile(self.cache_path):
             raise GPException('whois cache %s does not exist.' % self.cache_path)
 
-        warn('reading whois results...')
-        nlines = 0
-        self.cache = {}
-        f = gp_open(self.cache_path)
-        for line in f:
-            tokens = line.split('\t')
-            if len(tokens) == 2:
-                domain = tokens[0].strip()
-                whois = tokens[1].strip()
-                if not whois:
-                    self.cache[domain] = {}
-                elif whois.endswith('|p'):
-                    country = whois[:-2]
-                    if country != '??': self.cache[domain] = country
-                else:
-                    dist = {}
-                    for pair in whois.split(','):
-                        (country, n) = pair.split('|')
-                        dist[country] = int(n)
-                    total = 1.0 * sum(dist.values())
-                    if sum > 0:
-                        for c in dist: dist[c] /= total
-                    self.cache[domain] = dist
-                nlines += 1
-            else:
-                warn('invalid whois line: %s' % `line`)
-        warn('finished reading %d whois entries' % nlines)
-        f.close()
+        self.cache = open_feature_cache(self.cache_path, decode_whois_value, 'whois')
 
-        self.countries = read_countries()
-        self.aliases = read_aliases()
-        self.regexes = build_regexes(self.aliases)
+        # remember which whois server IANA refers each TLD to
+        servers_path = os.path.join(os.path.dirname(self.cache_path), 'whois_servers.tsv')
+        pythonwhois.net.set_root_server_cache(servers_path)
+
+        self.archive = None
+        if ARCHIVE_RAW_WHOIS:
+            self.archive = RecordArchive(get_whois_archive_path(self.cache_path))
+
+        # loaded on the first whois query, since cached answers don't need them
+        self.countries = None
+        self.alias_index = None
+        self.matcher = None
+
+    def load_aliases(self):
+        if not self.alias_index:
+            self.countries = read_countries()
+            self.alias_index = get_alias_index()
+            self.matcher = get_alias_matcher()
+
+    def is_cached(self, url):
+        """
+        Returns true if the url can be answered without a whois query.
+        """
+        d = get_url_info(url).registered_domain
+        return not d or d in self.cache
 
     def getParsed(self, url):
         """
         Retrieves the country code associated with a URL using the structured
         strategy, or returns None if it does not succeed.
         """
-        d = url2registereddomain(url)
+        d = get_url_info(url).registered_domain
         if not d:
             return None
-        if d not in self.cache:
+        r = self.cache.get(d, SKIP)
+        if r is SKIP:
             self.add_to_cache(d)
-        if d not in self.cache or type(self.cache[d]) not in (type(''), type(u'')):
+            r = self.cache.get(d)
+        if type(r) not in (type(''), type(u'')):
             return None
-        return self.cache[d]
+        return r
 
     def getFreetext(self, url):
         """
@@ -92,45 +109,102 @@ class WhoisProvider:
         mentions of them in the whois record. Returns None on failure, and an
         empty dictionary if no entities are found.
         """
-        d = url2registereddomain(url)
+        d = get_url_info(url).registered_domain
         if not d:
             return None
-        if d not in self.cache:
+        r = self.cache.get(d, SKIP)
+        if r is SKIP:
             self.add_to_cache(d)
-        if d not in self.cache or type(self.cache[d]) != type({}):
+            r = self.cache.get(d)
+        if type(r) != type({}):
             return None
-        return self.cache[d]
+        return r
 
     def add_to_cache(self, domain):
-        raw = None
         try:
             raw = retrieve_whois_record(domain)
         except:
-            warn('whois lookup for %s failed: %s' % (domain, sys.exc_info()[1]))
-            self.cache[domain] = {}
-            self.add_cache_line(domain + u'\t')
+            self.add_failure(domain, sys.exc_info()[1])
             return
+        self.add_records(domain, raw)
 
-        try:
-            parsed = extract_parsed_whois_country(raw, self.countries, self.aliases)
-            if parsed:
-                self.cache[domain] = parsed
-                self.add_cache_line(domain + u'\t' + parsed + '|p')
-                return
-        except:
-            warn('parsing of whois record for %s failed: %s. Resorting to freetext method.'
-                 % (domain, sys.exc_info()[1]))
-
-        freetext = extract_freetext_whois_country(raw, self.regexes)
-        if freetext:
-            self.cache[domain] = freetext
-            pairs = [u'%s|%s' % (cc, n) for (cc, n) in freetext.items()]
-            self.add_cache_line(domain + u'\t' + u','.join(pairs))
-
-    def add_cache_line(self, line):
-        f = gp_open(self.cache_path, 'a')
-        f.write(line + u'\n')
-        f.close()
+    def add_failure(self, domain, error):
+        if isinstance(error, pythonwhois.shared.WhoisTimeout):
+            # the server may just be slow, so only give up on the domain for this run
+            warn('whois lookup for %s timed out: %s' % (domain, error))
+            self.cache.remember(domain, {})
+        else:
+            warn('whois lookup for %s failed: %s' % (domain, error))
+            self.cache.put(domain, u'')
+
+    def add_records(self, domain, raw):
+        if self.archive:
+            self.archive.put(domain, raw)
+        self.load_aliases()
+        value = whois_cache_value(domain, raw, self.countries, self.alias_index, self.matcher)
+        if value is not None:
+            self.cache.put(domain, value)
+
+    def fill(self, urls, scheduler):
+        """
+        Looks up the whois records of the urls' domains that aren't cached,
+        many at a time through a whoisscheduler.WhoisScheduler.
+        """
+        domains = set()
+        for url in urls:
+            d = get_url_info(url).registered_domain
+            if d and d not in self.cache:
+                domains.add(d)
+        warn('looking up whois records for %d domains' % len(domains))
+        self.load_aliases()
+
+        def finish(domain, raw, error):
+            if error is not None:
+                self.add_failure(domain, error)
+            else:
+                self.add_records(domain, raw)
+        scheduler.lookup_all(sorted(domains), finish)
+
+def whois_cache_value(domain, raw, countries, alias_index, matcher):
+    """
+    Returns the whois cache value for a domain's raw whois records (see
+    decode_whois_value), or None if no country could be found.
+    """
+    try:
+        parsed = extract_parsed_whois_country(raw, countries, alias_index)
+        if parsed:
+            return parsed + u'|p'
+    except:
+        warn('parsing of whois record for %s failed: %s. Resorting to freetext method.'
+             % (domain, sys.exc_info()[1]))
+
+    freetext = extract_freetext_whois_country(raw, matcher)
+    if freetext:
+        pairs = [u'%s|%s' % (cc, n) for (cc, n) in freetext.items()]
+        return u','.join(pairs)
+    return None
+
+
+def decode_whois_value(whois):
+    """
+    Decodes a whois cache value: a country code ending in "|p" for parsed
+    records, "cc|n,cc|n" mention counts for freetext records, or empty
+    for failed lookups. Freetext counts are normalized to sum to 1.
+    """
+    if not whois:
+        return {}
+    elif whois.endswith('|p'):
+        country = whois[:-2]
+        return SKIP if country == '??' else country
+    else:
+        dist = {}
+        for pair in whois.split(','):
+            (country, n) = pair.split('|')
+            dist[country] = int(n)
+        total = 1.0 * sum(dist.values())
+        if total > 0:
+            for c in dist: dist[c] /= total
+        return dist
 
 PROVIDER_INST = None
 
@@ -142,6 +216,10 @@ class ParsedWhoisFeature:
             provider = PROVIDER_INST
         self.provider = provider
         self.name = 'parsed_whois'
+        self.domain_only = True
+        self.cost = 3
+        self.service = 'whois'
+        self.index = get_country_index()
 
     def infer(self, url):
         r = self.provider.getParsed(url)
@@ -150,6 +228,16 @@ class ParsedWhoisFeature:
         else:
             return (0, {})
 
+    def infer_array(self, url):
+        r = self.provider.getParsed(url)
+        if r:
+            return (0.60, self.index.point(r))
+        else:
+            return (0, None)
+
+    def is_cached(self, url):
+        return self.provider.is_cached(url)
+
 class FreetextWhoisFeature:
     def __init__(self, provider=None):
         global PROVIDER_INST
@@ -158,6 +246,10 @@ class FreetextWhoisFeature:
             provider = PROVIDER_INST
         self.provider = provider
         self.name = 'freetext_whois'
+        self.domain_only = True
+        self.cost = 3
+        self.service = 'whois'
+        self.index = get_country_index()
 
     def infer(self, url):
         r = self.provider.getFreetext(url)
@@ -167,6 +259,17 @@ class FreetextWhoisFeature:
         else:
             return (0, {})
 
+    def infer_array(self, url):
+        r = self.provider.getFreetext(url)
+        if r:
+            (indexes, counts) = self.index.sparse(r)
+            return (0.6, (indexes, counts / counts.sum()))
+        else:
+            return (0, None)
+
+    def is_cached(self, url):
+        return self.provider.is_cached(url)
+
 
 def retrieve_whois_record(domain):
     """
@@ -177,8 +280,22 @@ def retrieve_whois_record(domain):
 
 
 def extract_parsed_whois_country(records, countries, aliases):
-
-    # First try to extract a parsed record
+    """
+    Returns the country code of a whois record's contacts, or None.
+    aliases is an AliasIndex, or an alias dict; see as_alias_index().
+    """
+    aliases = as_alias_index(aliases)
+
+    # Fast path: look for just the contact countries, in priority order
+    segments = [r.replace('\r', '') for r in records]
+    for type in ('admin', 'tech', 'registrant'):
+        raw = pythonwhois.parse.parse_contact_country(segments, type)
+        if raw is False:
+            break   # needs the full parse
+        country_code = normalize_country(raw, aliases) if raw else None
+        if country_code: return country_code
+
+    # Then try to extract a fully parsed record
     result = pythonwhois.parse.parse_raw_whois(records)
     contact_countries = {}
     for (contact_type, contact_info) in result.get('contacts', {}).items():
@@ -207,7 +324,13 @@ def extract_parsed_whois_country(records, countries, aliases):
     return None # Failure!
 
 def extract_freetext_whois_country(records, regexes):
+    """
+    Counts the mentions of each country in a whois record. regexes is an
+    AliasMatcher, or a dict of per-country regexes from build_regexes().
+    """
     joined = '\n'.join(records).lower()
+    if isinstance(regexes, AliasMatcher):
+        return regexes.count(joined)
     dist = {}
     for (tld, tld_rx) in regexes.items():
         n = len(re.findall(tld_rx, joined))
@@ -215,13 +338,78 @@ def extract_freetext_whois_country(records, regexes):
     return dist
 
 def normalize_country(raw, aliases):
-    raw = raw.strip().lower()
-    if raw in aliases:
-        return raw  # it's a literal TLD
-    for tld in aliases:
-        if raw in aliases[tld]:
-            return tld
-    return None
+    """
+    Returns the country code for a raw country string, or None.
+    aliases is an AliasIndex, or an alias dict; see as_alias_index().
+    """
+    return as_alias_index(aliases).lookup(raw)
+
+def normalize_alias(alias):
+    """
+    Lowercases an alias and collapses punctuation and whitespace to single spaces.
+    """
+    return ' '.join(re.split(r'[\W_]+', alias.lower(), flags=re.UNICODE)).strip()
+
+class AliasIndex:
+    """
+    Maps country aliases to country codes with hash lookups. An exact
+    index holds the lowercased aliases, and a normalized index holds
+    their normalize_alias() forms for raw strings that differ only in
+    punctuation or whitespace. Normalized forms shared by aliases of
+    different countries are left out.
+    """
+    def __init__(self, aliases):
+        self.aliases = aliases
+        self.exact = {}
+        self.normalized = {}
+        for (cc, names) in aliases.items():
+            for a in names:
+                self.exact[a] = cc
+                n = normalize_alias(a)
+                if not n:
+                    continue
+                elif self.normalized.get(n, cc) != cc:
+                    self.normalized[n] = None   # ambiguous
+                else:
+                    self.normalized[n] = cc
+
+    def lookup(self, raw):
+        raw = raw.strip().lower()
+        if raw in self.aliases:
+            return raw  # it's a literal TLD
+        if raw in self.exact:
+            return self.exact[raw]
+        return self.normalized.get(normalize_alias(raw))
+
+# id(aliases) -> (aliases, AliasIndex); the dict is kept so its id is not reused
+ALIAS_INDEXES = {}
+
+def as_alias_index(aliases):
+    """
+    Returns aliases if it is an AliasIndex. Otherwise aliases is a dict from
+    country codes to aliases, and the AliasIndex built for it the first
+    time it was seen is returned, so the dict must not change after that.
+    """
+    if isinstance(aliases, AliasIndex):
+        return aliases
+    entry = ALIAS_INDEXES.get(id(aliases))
+    if entry is None:
+        entry = (aliases, AliasIndex(aliases))
+        ALIAS_INDEXES[id(aliases)] = entry
+    return entry[1]
+
+def get_alias_index():
+    """
+    Returns the AliasIndex for the aliases in the data directory, shared
+    by everything that normalizes country names.
+    """
+    return get_alias_artifact()['index']
+
+def get_alias_matcher():
+    """
+    Returns the shared AliasMatcher for the aliases in the data directory.
+    """
+    return get_alias_artifact()['matcher']
 
 def build_regexes(aliases):
     warn('building country alias regexes')
@@ -236,17 +424,100 @@ def build_regexes(aliases):
     warn('finished building %d country alias regexes' % n)
     return regexes
 
+# Positions matched by \b in the regexes from build_regexes()
+BOUNDARY_RE = re.compile(r'\b')
 
-def read_aliases(dir=DATA_DIR):
+class AliasMatcher:
+    """
+    Counts the aliases of every country in a single pass over a text, with
+    the same counts as running each country's build_regexes() regex.
+
+    Aliases are looked up by hash at each word boundary of the text, using
+    an index from the first few characters of an alias to the alias lengths
+    that share them. As in the regexes, a country's alias must end at a word
+    boundary, its earliest listed alias wins at each position, and its
+    matches do not overlap.
+    """
+    def __init__(self, aliases, prefix_len=4):
+        self.prefix_len = prefix_len
+        self.ranks = {}     # alias -> [(country, position in its alias list)]
+        lengths = collections.defaultdict(set)
+        short_lengths = set()
+        for (cc, names) in aliases.items():
+            for (rank, a) in enumerate(names):
+                if not a:
+                    continue
+                self.ranks.setdefault(a, []).append((cc, rank))
+                if len(a) < prefix_len:
+                    short_lengths.add(len(a))
+                else:
+                    lengths[a[:prefix_len]].add(len(a))
+        self.short_lengths = tuple(sorted(short_lengths))
+        self.lengths = dict((p, tuple(sorted(ls)) + self.short_lengths)
+                            for (p, ls) in lengths.items())
+
+    def count(self, text):
+        """
+        Returns a dict from country codes to the number of their aliases in text.
+        """
+        if isinstance(text, str):
+            text = text.decode('latin-1')   # the regexes compare bytes as code points
+        size = len(text)
+        bounds = set(m.start() for m in BOUNDARY_RE.finditer(text))
+
+        counts = {}
+        next_start = {}
+        for p in sorted(bounds | set([0])):
+            if p >= size:
+                continue
+            best = {}
+            for n in self.lengths.get(text[p:p + self.prefix_len], self.short_lengths):
+                e = p + n
+                matches = self.ranks.get(text[p:e])
+                if e > size or not matches:
+                    continue
+                if not (e in bounds or e == size or (e == size - 1 and text[e] == '\n')):
+                    continue
+                for (cc, rank) in matches:
+                    if p >= next_start.get(cc, 0) and (cc not in best or rank < best[cc][0]):
+                        best[cc] = (rank, e)
+            for (cc, (rank, e)) in best.items():
+                counts[cc] = counts.get(cc, 0) + 1
+                next_start[cc] = e
+        return counts
+
+    def count_all(self, texts):
+        """
+        Returns the counts for each of many texts.
+        """
+        return [self.count(t) for t in texts]
+
+def build_matcher(aliases):
+    return AliasMatcher(aliases)
+
+def extract_freetext_whois_countries(records_list, matcher):
+    """
+    Batch version of extract_freetext_whois_country for many whois records.
+    """
+    return matcher.count_all('\n'.join(records).lower() for records in records_list)
+
+
+def alias_source_paths(dir=None):
+    if dir is None:
+        return [get_data_path('manual_aliases.tsv'), get_data_path('geonames_aliases.tsv')]
+    return [dir + '/manual_aliases.tsv', dir + '/geonames_aliases.tsv']
+
+def read_aliases(dir=None):
+    (manual_path, geonames_path) = alias_source_paths(dir)
     ambiguous = {}
-    for line in gp_open(dir + '/manual_aliases.tsv'):
+    for line in gp_open(manual_path):
         tokens = line.split('\t')
         alias = tokens[0].strip().lower()
         code = tokens[1].strip().lower()
         ambiguous[alias] = code
 
     mapping = dict(ambiguous)
-    for line in gp_open(dir + '/geonames_aliases.tsv'):
+    for line in gp_open(geonames_path):
         tokens = line.split('\t')
 
         code = tokens[8].strip().lower()
@@ -266,6 +537,129 @@ def read_aliases(dir=DATA_DIR):
 
     return dict(aliases)
 
+
+# Bump when AliasIndex or AliasMatcher change, so that old artifacts are rebuilt.
+ALIAS_ARTIFACT_VERSION = 1
+
+def alias_artifact_key(dir=None):
+    """
+    Returns a key identifying the alias source files and artifact format.
+    """
+    h = hashlib.sha1(str(ALIAS_ARTIFACT_VERSION))
+    for path in alias_source_paths(dir):
+        f = open(path, 'rb')
+        h.update(f.read())
+        f.close()
+    return h.hexdigest()
+
+def alias_artifact_path(dir=None):
+    if dir is None:
+        return get_data_path('aliases.pickle')
+    return dir + '/aliases.pickle'
+
+def build_alias_artifact(dir=None):
+    """
+    Builds the alias map, AliasIndex and AliasMatcher and writes them to
+    aliases.pickle in the data directory. Returns the artifact, even if it
+    could not be written.
+    """
+    aliases = read_aliases(dir)
+    artifact = {
+        'key' : alias_artifact_key(dir),
+        'index' : AliasIndex(aliases),
+        'matcher' : AliasMatcher(aliases),
+    }
+    path = alias_artifact_path(dir)
+    tmp_path = None
+    try:
+        # each writer has its own temp file, since many workers may build at once
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                          prefix=os.path.basename(path) + '.', suffix='.tmp')
+        f = os.fdopen(fd, 'wb')
+        cPickle.dump(artifact, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        warn('could not write alias artifact %s: %s' % (path, sys.exc_info()[1]))
+        if tmp_path and os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+    return artifact
+
+def load_alias_artifact(dir=None):
+    """
+    Loads the alias artifact, rebuilding it if the alias files have changed.
+    """
+    key = alias_artifact_key(dir)
+    path = alias_artifact_path(dir)
+    if os.path.isfile(path):
+        try:
+            f = open(path, 'rb')
+            artifact = cPickle.load(f)
+            f.close()
+            if artifact.get('key') == key:
+                return artifact
+        except:
+            warn('could not read alias artifact %s: %s' % (path, sys.exc_info()[1]))
+    warn('building alias artifact %s' % path)
+    return build_alias_artifact(dir)
+
+# alias artifact path -> artifact, so a later set_data_dir() loads its own aliases
+ALIAS_ARTIFACTS = {}
+
+def get_alias_artifact():
+    path = alias_artifact_path()
+    if path not in ALIAS_ARTIFACTS:
+        ALIAS_ARTIFACTS[path] = load_alias_artifact()
+    return ALIAS_ARTIFACTS[path]
+
+def test_alias_artifact():
+    import shutil
+    import subprocess
+    dir = tempfile.mkdtemp()
+    try:
+        f = gp_open(dir + '/manual_aliases.tsv', 'w')
+        f.write(u'america\tus\n')
+        f.close()
+        f = gp_open(dir + '/geonames_aliases.tsv', 'w')
+        f.write(u'\t'.join([u'1', u'France', u'France', u'France,Republique francaise', u'', u'', u'', u'', u'FR']) + u'\n')
+        f.close()
+
+        artifact = load_alias_artifact(dir)
+        assert(os.path.isfile(alias_artifact_path(dir)))
+        assert(artifact['index'].lookup('Republique  Francaise') == 'fr')
+        assert(load_alias_artifact(dir)['key'] == artifact['key'])
+
+        # changing a source file invalidates the artifact
+        f = gp_open(dir + '/manual_aliases.tsv', 'a')
+        f.write(u'deutschland\tde\n')
+        f.close()
+        artifact = load_alias_artifact(dir)
+        assert(artifact['key'] == alias_artifact_key(dir))
+        assert(artifact['matcher'].count(u'america and deutschland') == {'us' : 1, 'de' : 1})
+        assert([n for n in os.listdir(dir) if n.endswith('.tmp')] == [])
+
+        # the shared artifact follows the data directory
+        default_index = get_alias_index()
+        old_dir = get_data_dir()
+        set_data_dir(dir)
+        try:
+            assert(get_alias_index().lookup('deutschland') == 'de')
+            assert(get_alias_index() is not default_index)
+        finally:
+            set_data_dir(old_dir)
+        assert(get_alias_index() is default_index)
+
+        # an artifact prebuilt by running this module loads when it is imported
+        os.remove(alias_artifact_path(dir))
+        subprocess.check_call([sys.executable, os.path.abspath(__file__.replace('.pyc', '.py')), dir],
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+        assert('__main__' not in open(alias_artifact_path(dir), 'rb').read())
+        f = open(alias_artifact_path(dir), 'rb')
+        assert(cPickle.load(f)['key'] == alias_artifact_key(dir))
+        f.close()
+    finally:
+        shutil.rmtree(dir)
+
 def test_parsed_provider():
     provider = WhoisProvider()
     assert(not provider.getParsed('foo'))
@@ -275,6 +669,7 @@ def test_parsed_provider():
 def test_freetext_provider():
     provider = WhoisProvider()
     assert(provider.getFreetext('http://foo.google.ca/foo/bar') == {'us' : 0.5, 'ca' : 0.5})
+    assert(provider.alias_index is None)
 
 def test_online_whois():
     countries = read_countries()
@@ -296,8 +691,148 @@ def test_freetext_whois():
     assert(freetext == {'us' : 3})
 
 
+def test_alias_index():
+    index = AliasIndex({ 'us' : [u'united states', u'u.s.a.'], 'de' : [u'germany'] })
+    assert(index.lookup(' US ') == 'us')
+    assert(index.lookup('Germany') == 'de')
+    assert(index.lookup('United  States') == 'us')
+    assert(index.lookup('U.S.A.') == 'us')
+    assert(index.lookup('usa') is None)
+    assert(index.lookup('united-states') == 'us')
+    assert(index.lookup('france') is None)
+    aliases = { 'de' : [u'germany'] }
+    assert(normalize_country('germany', aliases) == 'de')
+    assert(as_alias_index(aliases) is as_alias_index(aliases))
+    assert(as_alias_index(index) is index)
+
+def test_alias_matcher():
+    aliases = {
+        'us' : [u'united states', u'usa', u'united states of america'],
+        'gb' : [u'uk', u'united kingdom', u'u.k.'],
+        'ca' : [u'canada', u'dominion of canada'],
+        'xx' : [u'.k.'],
+    }
+    matcher = build_matcher(aliases)
+    regexes = build_regexes(aliases)
+    texts = [
+        'united states of america, usa. usa\n',
+        'dominion of canada; canada canadas ucanada canada',
+        'uk/u.k. u.k.. united kingdomx united kingdom\n',
+        'usa\nusa\n\n',
+        '',
+        u'caf\xe9 uk\xe9 uk',
+    ]
+    for t in texts:
+        assert(matcher.count(t) == extract_freetext_whois_country([t], regexes))
+    assert(extract_freetext_whois_countries([[t] for t in texts], matcher)
+           == [extract_freetext_whois_country([t], regexes) for t in texts])
+
+def test_root_server_cache():
+    import tempfile
+    net = pythonwhois.net
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    queries = []
+    def query(domain):
+        queries.append(domain)
+        if domain.endswith('.zz'):
+            raise pythonwhois.shared.WhoisException('No root WHOIS server found for domain.')
+        return 'whois.example.' + domain.split('.')[-1]
+    real_query = net.query_root_server
+    net.query_root_server = query
+    try:
+        net.set_root_server_cache(path)
+        assert(net.get_root_server('shilad.com') == 'whois.verisign-grs.com')   # bundled
+        assert(net.get_root_server('foo.example') == 'whois.example.example')
+        assert(net.get_root_server('bar.example') == 'whois.example.example')
+        assert(queries == ['foo.example'])
+
+        # learned referrals persist, and are asked for again once stale
+        net.set_root_server_cache(path)
+        assert(net.get_root_server('baz.example') == 'whois.example.example')
+        assert(queries == ['foo.example'])
+        net.root_servers['example'] = ('whois.old.example', 0.0)
+        assert(net.get_root_server('baz.example') == 'whois.example.example')
+        assert(queries == ['foo.example', 'baz.example'])
+
+        # TLDs without a whois server are remembered too
+        for d in ('a.zz', 'b.zz'):
+            try:
+                net.get_root_server(d)
+                assert(False)
+            except pythonwhois.shared.WhoisException:
+                pass
+        assert(queries == ['foo.example', 'baz.example', 'a.zz'])
+        net.set_root_server_cache(path)
+        assert(net.load_root_servers()['zz'][0] is None)
+    finally:
+        net.query_root_server = real_query
+        net.set_root_server_cache(None)
+        os.remove(path)
+
+class StallingWhoisServer(threading.Thread):
+    """
+    A local whois server that sends a response and then stalls for a while
+    before closing the connection.
+    """
+    def __init__(self, response, stall):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.response = response
+        self.stall = stall
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        (conn, addr) = self.sock.accept()
+        conn.recv(1024)
+        conn.sendall(self.response)
+        time.sleep(self.stall)
+        conn.close()
+        self.sock.close()
+
+def test_whois_request_limits():
+    net = pythonwhois.net
+    saved = (net.rate_limiter, net.read_timeout, net.max_response_size)
+    net.rate_limiter = None
+    net.read_timeout = 0.2
+    net.max_response_size = 1000
+    try:
+        server = StallingWhoisServer('Domain Name: FOO.COM\n', 0.0)
+        server.start()
+        assert(net.whois_request('foo.com', '127.0.0.1', server.port) == u'Domain Name: FOO.COM\n')
+
+        server = StallingWhoisServer('x' * 5000, 0.0)
+        server.start()
+        assert(len(net.whois_request('foo.com', '127.0.0.1', server.port)) == 1000)
+
+        server = StallingWhoisServer('partial', 1.0)
+        server.start()
+        try:
+            net.whois_request('foo.com', '127.0.0.1', server.port)
+            assert(False)
+        except pythonwhois.shared.WhoisTimeout:
+            pass
+    finally:
+        (net.rate_limiter, net.read_timeout, net.max_response_size) = saved
+
+def test_contact_country():
+    aliases = get_alias_index()
+    record = (
+        'Registrant Name: Jane Doe\r\nRegistrant Street: 1 Main St\r\nRegistrant City: Paris\r\n'
+        'Registrant State/Province: \r\nRegistrant Postal Code: 75001\r\nRegistrant Country: France\r\n'
+        'Admin Name: John Doe\r\nAdmin Street: 2 Main St\r\nAdmin City: Berlin\r\n'
+        'Admin State/Province: \r\nAdmin Postal Code: 10115\r\nAdmin Country: DE\r\n')
+    assert(pythonwhois.parse.parse_contact_country([record.replace('\r', '')], 'admin') == 'DE')
+    assert(pythonwhois.parse.parse_contact_country([record.replace('\r', '')], 'tech') is None)
+    assert(extract_parsed_whois_country([record], None, aliases) == 'de')
+    assert(extract_parsed_whois_country([record.replace('Admin', 'Billing')], None, aliases) == 'fr')
+    assert(pythonwhois.parse.parse_contact_country(['admin-c: JD123-RIPE\n'], 'admin') is False)
+
 def test_parsed():
-    aliases = read_aliases()
+    aliases = get_alias_index()
     records = [
         """
 Whois Server Version 2.0
@@ -429,4 +964,14 @@ NOT INDICATE DOMAIN AVAILABILITY.
         """
         ]
     freetext = extract_parsed_whois_country(records, read_countries(), aliases)
-    assert(freetext == 'gb')
\ No newline at end of file
+    assert(freetext == 'gb')
+
+
+if __name__ == '__main__':
+    # Prebuilds the alias artifact so that workers don't each build it.
+    # The classes are pickled from the imported module, not __main__, so
+    # that programs importing whois can load them.
+    import whois
+    if len(sys.argv) > 1:
+        whois.set_data_dir(sys.argv[1])
+    whois.build_alias_artifact()
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+#
+# Rebuilds the whois feature cache from the archive of raw whois records
+# that WhoisProvider keeps when run with whois.set_archive_raw_whois(True)
+# (run_inferrer.py --archive-whois). Records are parsed by a pool of
+# processes without any network queries, so improvements to the parsers
+# or alias lists can be applied to every archived domain:
+#
+#   python whoisarchive.py [--processes N] [feature_dir] [data_dir]
+#
+
+import argparse
+import multiprocessing
+import os
+
+from gputils import *
+from featurecache import RecordArchive, split_cache_line
+from country import read_countries
+from whois import whois_cache_value, get_alias_index, get_alias_matcher, get_whois_archive_path
+
+
+PARSER_INST = None
+
+def get_parser():
+    """
+    Returns the (countries, alias index, matcher) used to parse records.
+    It is loaded before the pool starts, so forked workers share it.
+    """
+    global PARSER_INST
+    if not PARSER_INST:
+        PARSER_INST = (read_countries(), get_alias_index(), get_alias_matcher())
+    return PARSER_INST
+
+def reparse_record(item):
+    (domain, raw) = item
+    (countries, alias_index, matcher) = get_parser()
+    return (domain, whois_cache_value(domain, raw, countries, alias_index, matcher))
+
+def reparse(cache_path=None, processes=None):
+    """
+    Rewrites the whois cache with values reparsed from its archive, keeping
+    the entries for domains that were never archived. Returns the number
+    of archived records that were reparsed.
+    """
+    if not cache_path: cache_path = get_feature_data_path('whois')
+    archive = RecordArchive(get_whois_archive_path(cache_path))
+    get_parser()
+
+    tmp_path = cache_path + '.reparse'
+    out = gp_open(tmp_path, 'w')
+    for line in gp_open(cache_path):
+        pair = split_cache_line(line)
+        if pair and pair[0] not in archive:
+            out.write(line if line.endswith('\n') else line + '\n')
+
+    n = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        for (domain, value) in pool.imap(reparse_record, archive.scan(), 100):
+            if value is not None:
+                out.write(domain + u'\t' + value + u'\n')
+            n += 1
+            if n % 10000 == 0:
+                warn('reparsed %d whois records' % n)
+    finally:
+        pool.close()
+        pool.join()
+        archive.close()
+    out.close()
+
+    os.rename(tmp_path, cache_path)
+    if os.path.isfile(cache_path + '.sqlite'):
+        os.remove(cache_path + '.sqlite')  # its offsets no longer match the file
+    return n
+
+
+def test_reparse():
+    import shutil
+    import tempfile
+    from featurecache import close_cache_writers
+
+    dir = tempfile.mkdtemp()
+    try:
+        cache_path = dir + '/whois.tsv'
+        f = gp_open(cache_path, 'w')
+        f.write(u'kept.com\tfr|p\nstale.com\tus|p\nfailed.com\t\n')
+        f.close()
+
+        archive = RecordArchive(get_whois_archive_path(cache_path))
+        archive.put('stale.com', [u'Admin Name: A\nAdmin Street: 1 Main St\nAdmin City: Berlin\n'
+                                  u'Admin State/Province: \nAdmin Postal Code: 10115\nAdmin Country: DE\n'])
+        archive.put('freetext.org', [u'located in canada'])
+        archive.put('nothing.net', [u'no countries here'])
+        archive.close()
+        close_cache_writers()
+
+        assert(reparse(cache_path, processes=2) == 3)
+        lines = sorted(l.rstrip('\n') for l in gp_open(cache_path))
+        assert(lines == [u'failed.com\t', u'freetext.org\tca|1', u'kept.com\tfr|p', u'stale.com\tde|p'])
+    finally:
+        close_cache_writers()
+        shutil.rmtree(dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuilds the whois feature cache from archived raw records.')
+    parser.add_argument('feature_dir', nargs='?', help='directory containing the feature caches')
+    parser.add_argument('data_dir', nargs='?', help='directory containing the data files')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of parsing processes (default: one per core)')
+    args = parser.parse_args()
+
+    if args.feature_dir:
+        set_feature_dir(args.feature_dir)
+    if args.data_dir:
+        set_data_dir(args.data_dir)
+
+    n = reparse(processes=args.processes)
+    warn('reparsed %d archived whois records' % n)
@@ -0,0 +1,254 @@
+#!/usr/bin/python
+#
+# Looks up the whois records of many domains at once, spreading the load
+# across whois servers. Reads urls or domains from stdin and fills the
+# whois feature cache:
+#
+#   python whoisscheduler.py [--workers N] [feature_dir] [data_dir] < urls.txt
+#
+# Each lookup follows the same referral chain as get_whois_raw, but every
+# request is queued at its target server. Servers are worked on
+# concurrently, each within its own concurrency and query rate limits,
+# and a server that times out, refuses connections or sends empty replies
+# is backed off exponentially.
+#
+
+import argparse
+import collections
+import socket
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import pythonwhois
+from gputils import *
+
+
+# default limits for each whois server: (concurrent requests, queries per second)
+DEFAULT_SERVER_LIMITS = (2, 1.0)
+
+
+class EmptyResponse(pythonwhois.shared.WhoisException):
+    pass
+
+
+class WhoisLookup:
+    def __init__(self, domain):
+        self.domain = domain
+        self.encoded = None
+        self.server = ''        # the server asked for, as in get_whois_raw
+        self.target = None      # the server to query next
+        self.records = []
+        self.retries = 0
+
+
+class ServerQueue:
+    def __init__(self, name, concurrency, qps):
+        self.name = name
+        self.concurrency = concurrency
+        self.min_interval = 1.0 / qps if qps else 0.0
+        self.pending = collections.deque()
+        self.active = 0
+        self.next_start = 0.0
+        self.failures = 0
+
+    def ready_at(self):
+        """
+        Returns when the next pending lookup may start, or None if it must
+        wait for an active one to finish.
+        """
+        if not self.pending or self.active >= self.concurrency:
+            return None
+        return self.next_start
+
+
+class WhoisScheduler:
+    def __init__(self, workers=50, limits=None, max_retries=3, backoff=2.0, max_backoff=300.0):
+        """
+        limits maps server names to (concurrency, qps) pairs, overriding
+        DEFAULT_SERVER_LIMITS.
+        """
+        self.workers = workers
+        self.limits = limits or {}
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.servers = {}
+        self.outstanding = 0
+        self.condition = threading.Condition()
+
+    def get_queue(self, name):
+        if name not in self.servers:
+            if name is None:
+                # resolving first servers only queries IANA on a root server cache miss
+                (concurrency, qps) = (self.workers, None)
+            else:
+                (concurrency, qps) = self.limits.get(name, DEFAULT_SERVER_LIMITS)
+            self.servers[name] = ServerQueue(name, concurrency, qps)
+        return self.servers[name]
+
+    def lookup_all(self, domains, callback):
+        """
+        Looks up the whois records of domains. As each lookup finishes,
+        callback(domain, records, error) is called from a worker thread,
+        with exactly one of records and error set.
+        """
+        pool = ThreadPool(self.workers)
+        try:
+            with self.condition:
+                for d in domains:
+                    self.get_queue(None).pending.append(WhoisLookup(d))
+                    self.outstanding += 1
+                while self.outstanding > 0:
+                    now = time.time()
+                    wake = None
+                    for queue in self.servers.values():
+                        t = queue.ready_at()
+                        while t is not None and t <= now:
+                            lookup = queue.pending.popleft()
+                            queue.active += 1
+                            queue.next_start = max(queue.next_start, now) + queue.min_interval
+                            pool.apply_async(self.step, (queue, lookup, callback))
+                            t = queue.ready_at()
+                        if t is not None:
+                            wake = t if wake is None else min(wake, t)
+                    self.condition.wait(None if wake is None else max(wake - now, 0.01))
+        finally:
+            pool.close()
+            pool.join()
+
+    def step(self, queue, lookup, callback):
+        next_queue = None
+        try:
+            if lookup.target is None:
+                lookup.encoded = pythonwhois.net.encode_domain(lookup.domain)
+                lookup.target = pythonwhois.net.get_first_server(lookup.encoded)
+                next_queue = lookup.target
+            else:
+                request = pythonwhois.net.get_request_domain(lookup.encoded, lookup.target)
+                response = pythonwhois.net.send_request(request, lookup.target)
+                if not response.strip():
+                    raise EmptyResponse('empty response from %s' % lookup.target)
+                (lookup.records, referral) = pythonwhois.net.process_response(
+                        lookup.encoded, lookup.server, lookup.target, response, lookup.records)
+                if referral is not None:
+                    lookup.server = lookup.target = next_queue = referral
+            queue.failures = 0
+        except (socket.error, pythonwhois.shared.WhoisException):
+            error = sys.exc_info()[1]
+            # Resolving the first server is not a request to a whois server,
+            # and often fails for good (a TLD without one), so it just fails
+            # the domain rather than backing off every unresolved lookup.
+            if queue.name is not None:
+                with self.condition:
+                    queue.failures += 1
+                    delay = min(self.max_backoff, self.backoff * 2 ** (queue.failures - 1))
+                    queue.next_start = max(queue.next_start, time.time() + delay)
+                    lookup.retries += 1
+                    if lookup.retries <= self.max_retries:
+                        queue.pending.appendleft(lookup)
+                        self.finish_step(queue)
+                        return
+            if lookup.records:
+                self.finish_lookup(queue, lookup, callback, lookup.records, None)
+            else:
+                self.finish_lookup(queue, lookup, callback, None, error)
+            return
+        except:
+            self.finish_lookup(queue, lookup, callback, None, sys.exc_info()[1])
+            return
+
+        if next_queue is None:
+            self.finish_lookup(queue, lookup, callback, lookup.records, None)
+        else:
+            with self.condition:
+                self.get_queue(next_queue).pending.append(lookup)
+                self.finish_step(queue)
+
+    def finish_step(self, queue):
+        queue.active -= 1
+        self.condition.notify()
+
+    def finish_lookup(self, queue, lookup, callback, records, error):
+        try:
+            callback(lookup.domain, records, error)
+        except:
+            warn('whois callback for %s failed: %s' % (lookup.domain, sys.exc_info()[1]))
+        with self.condition:
+            self.outstanding -= 1
+            self.finish_step(queue)
+
+
+def test_scheduler():
+    net = pythonwhois.net
+    lock = threading.Lock()
+    active = collections.defaultdict(int)
+    max_active = collections.defaultdict(int)
+    refusals = set(['b.org'])
+
+    def send_request(request, server):
+        with lock:
+            active[server] += 1
+            max_active[server] = max(max_active[server], active[server])
+        time.sleep(0.02)
+        with lock:
+            active[server] -= 1
+            if server == 'whois.org' and request in refusals:
+                refusals.remove(request)
+                return ''
+        if server == 'whois.com':
+            return 'Domain Name: %s\nWhois Server: whois.registrar.com\n' % request.upper()
+        return 'record for %s from %s' % (request, server)
+
+    def get_first_server(domain):
+        if domain.endswith('.zz'):
+            raise pythonwhois.shared.WhoisException('No root WHOIS server found for domain.')
+        return 'whois.' + domain.split('.')[-1]
+
+    saved = (net.send_request, net.get_first_server)
+    net.send_request = send_request
+    net.get_first_server = get_first_server
+    results = {}
+    errors = {}
+    def callback(domain, records, error):
+        results[domain] = records
+        errors[domain] = error
+    try:
+        domains = ['a%d.com' % i for i in range(6)] + ['b.org', 'c.org'] + ['x%d.zz' % i for i in range(4)]
+        scheduler = WhoisScheduler(workers=10, backoff=0.01,
+                                   limits={'whois.com' : (3, None), 'whois.org' : (1, None),
+                                           'whois.registrar.com' : (2, 100.0)})
+        scheduler.lookup_all(domains, callback)
+    finally:
+        (net.send_request, net.get_first_server) = saved
+
+    assert(sorted(results) == sorted(domains))
+    # unresolvable TLDs fail right away, without backing off other lookups
+    assert(all(errors['x%d.zz' % i] for i in range(4)))
+    assert(scheduler.servers[None].failures == 0)
+    assert(results['a0.com'] == ['record for a0.com from whois.registrar.com',
+                                 'Domain Name: A0.COM\nWhois Server: whois.registrar.com\n'])
+    assert(results['b.org'] == ['record for b.org from whois.org'])
+    assert(max_active['whois.com'] <= 3 and max_active['whois.org'] == 1)
+    assert(max_active['whois.registrar.com'] <= 2)
+
+
+if __name__ == '__main__':
+    from whois import WhoisProvider
+
+    parser = argparse.ArgumentParser(description='Fills the whois feature cache for urls or domains read from stdin.')
+    parser.add_argument('feature_dir', nargs='?', help='directory containing the feature caches')
+    parser.add_argument('data_dir', nargs='?', help='directory containing the data files')
+    parser.add_argument('--workers', type=int, default=50,
+                        help='number of whois requests in flight across all servers (default 50)')
+    args = parser.parse_args()
+
+    if args.feature_dir:
+        set_feature_dir(args.feature_dir)
+    if args.data_dir:
+        set_data_dir(args.data_dir)
+
+    provider = WhoisProvider()
+    urls = [line.strip() for line in sys.stdin if line.strip()]
+    provider.fill(urls, WhoisScheduler(workers=args.workers))
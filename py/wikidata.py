@@ -13,12 +13,19 @@ import os
 import traceback
 
 from gputils import *
+from featurecache import open_feature_cache
+from country import get_country_index
+from geocoder import get_geocoder
+
+# nominatim's usage policy allows at most one request per second
+NOMINATIM_LIMITER = RateLimiter(1.0)
 
 class WikidataProvider:
     """
     Resolves a URL to a country using information from the Wikidata project.
     Uses a precomputed mapping from domain to lat/long coordinate stored in data/wikidata.json.
-    These coordinates are geocoded to country on the fly using OpenStreetMap's nominatom API.
+    These coordinates are geocoded to country on the fly, offline if data/countries.geojson
+    exists (see geocoder.py) and otherwise using OpenStreetMap's nominatom API.
     Results are cached so that domains are only geocoded once.
     """
     def __init__(self, cache_path=None):
@@ -26,28 +33,21 @@ class WikidataProvider:
         if not os.path.isfile(cache_path):
             raise GPException('wikidata results not available...')
         self.cache_path = cache_path
-
-        warn('reading wikidata results...')
-        n = 0
-        self.domains = {}
-        for line in gp_open(self.cache_path):
-            tokens = line.split('\t')
-            if len(tokens) == 2:
-                domain = tokens[0].strip()
-                iso = tokens[1].strip()
-                if not iso: iso = None
-                self.domains[domain] = iso
-                n += 1
-            else:
-                warn('invalid wikidata line: %s' % `line`)
-        warn('finished reading %d wikidata entries' % n)
+        self.domains = open_feature_cache(self.cache_path, lambda iso: iso or None, 'wikidata')
 
         f = open(get_data_path('wikidata.json'))
         self.domain_coords = json.load(f)
         f.close()
 
+    def is_cached(self, url):
+        """
+        Returns true if get() can answer for the url without a geocoding request.
+        """
+        domain = get_url_info(url).registered_domain
+        return not domain or get_geocoder() is not None or bool(self.domains.get(domain)) or domain not in self.domain_coords
+
     def get(self, url):
-        domain = url2registereddomain(url)
+        domain = get_url_info(url).registered_domain
         if not domain:
             return None
         r = self.domains.get(domain)
@@ -56,22 +56,20 @@ class WikidataProvider:
         elif domain in self.domain_coords:
             coords = self.domain_coords[domain]
             cc = coord_to_country(coords)
-            self.domains[domain] = cc
-            self.add_cache_line(domain + u'\t' + (cc if cc else ''))
+            self.domains.put(domain, cc if cc else u'')
             return cc
         else:
             return None
 
-    def add_cache_line(self, line):
-        f = gp_open(self.cache_path, 'a')
-        f.write(line + u'\n')
-        f.close()
-
 class WikidataFeature:
     def __init__(self, provider=None):
         if not provider: provider = WikidataProvider()
         self.provider = provider
         self.name = 'wikidata'
+        self.domain_only = True
+        self.cost = 2
+        self.service = 'geocode'
+        self.index = get_country_index()
 
     def infer(self, url):
         r = self.provider.get(url)
@@ -80,6 +78,16 @@ class WikidataFeature:
         else:
             return (0, {})
 
+    def infer_array(self, url):
+        r = self.provider.get(url)
+        if r:
+            return (0.99, self.index.point(r))
+        else:
+            return (0, None)
+
+    def is_cached(self, url):
+        return self.provider.is_cached(url)
+
 def test_wikidata():
     provider = WikidataProvider()
     assert(not provider.get('foo'))
@@ -92,12 +100,18 @@ def test_coord_to_country():
     assert(coord_to_country("25.269722|55.309444|0.000000|0") == 'ae')
 
 
-def coord_to_country(wikidata_coord):
+def parse_coord(wikidata_coord):
     parts = wikidata_coord.split('|')
-    lat = float(parts[0])
-    lng = float(parts[1])
+    return (float(parts[0]), float(parts[1]))
+
+def coord_to_country(wikidata_coord):
+    (lat, lng) = parse_coord(wikidata_coord)
+    geocoder = get_geocoder()
+    if geocoder:
+        return geocoder.country_at(lat, lng)
 
     url = 'http://nominatim.openstreetmap.org/reverse?format=json&lat=%.4f&lon=%.4f' % (lat, lng)
+    NOMINATIM_LIMITER.wait()
     f = urllib2.urlopen(url)
     js = json.load(f)
     if js and js['address'] and js['address']['country_code']:
@@ -105,6 +119,34 @@ def coord_to_country(wikidata_coord):
     else:
         return None
 
+def geocode_all(cache_path=None):
+    """
+    Rewrites the wikidata cache with the country of every coordinate in
+    data/wikidata.json, resolved in one pass by the offline geocoder.
+    """
+    geocoder = get_geocoder()
+    if not geocoder:
+        raise GPException('offline geocoding needs %s' % get_data_path('countries.geojson'))
+    if not cache_path: cache_path = get_feature_data_path('wikidata')
+
+    f = open(get_data_path('wikidata.json'))
+    domain_coords = json.load(f)
+    f.close()
+
+    domains = sorted(domain_coords)
+    coords = [parse_coord(domain_coords[d]) for d in domains]
+    codes = geocoder.countries_at([c[0] for c in coords], [c[1] for c in coords])
+
+    tmp_path = cache_path + '.geocode'
+    out = gp_open(tmp_path, 'w')
+    for (domain, cc) in zip(domains, codes):
+        out.write(domain + u'\t' + (cc or u'') + u'\n')
+    out.close()
+    os.rename(tmp_path, cache_path)
+    if os.path.isfile(cache_path + '.sqlite'):
+        os.remove(cache_path + '.sqlite')  # stale; rebuilt from the new file when next opened
+    warn('geocoded %d of %d wikidata coordinates' % (len(filter(None, codes)), len(codes)))
+
 def rebuild():
     all_urls = 'http://wdq.wmflabs.org/api?props=856,159,625&q=CLAIM[856]%20AND%20(CLAIM[159]%20OR%20CLAIM[625])'
 
@@ -142,4 +184,7 @@ def rebuild():
     f.close()
 
 if __name__ == '__main__':
-    rebuild()
+    if sys.argv[1:] == ['geocode']:
+        geocode_all()
+    else:
+        rebuild()